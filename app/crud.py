@@ -1,6 +1,6 @@
 # app/crud.py
 from sqlalchemy.orm import Session
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Callable
 import datetime # 标准库
 
 from . import models, schemas
@@ -83,6 +83,15 @@ def get_holiday_date(db: Session, date_str: str) -> Optional[models.HolidayDateD
 def get_holiday_dates_for_year(db: Session, year: int) -> List[models.HolidayDateDB]:
     return db.query(models.HolidayDateDB).filter(models.HolidayDateDB.year == year).order_by(models.HolidayDateDB.date).all()
 
+def make_holiday_dates_getter(db: Session) -> Callable[[int], List[models.HolidayDateDB]]:
+    """返回按年份缓存查询结果的日历数据获取函数，同一次计算中每个年份只查询一次数据库。"""
+    cache: Dict[int, List[models.HolidayDateDB]] = {}
+    def get_holidays_for_year(year: int) -> List[models.HolidayDateDB]:
+        if year not in cache:
+            cache[year] = get_holiday_dates_for_year(db, year)
+        return cache[year]
+    return get_holidays_for_year
+
 def create_or_update_holiday_dates(db: Session, year: int, holiday_data_list: List[Dict[str, Any]]):
     print(f"正在为年份 {year} 创建或更新日历数据...")
     created_count = 0
@@ -69,10 +69,9 @@ async def health_check():
 @app.post(f"{settings.API_V1_STR}/tasks/", response_model=schemas.TaskResponse, status_code=status.HTTP_201_CREATED, summary="创建新提醒任务 (结构化)", tags=["任务管理"], dependencies=[Depends(get_api_key)])
 async def create_new_task_structured(task_request: schemas.TaskCreateRequest, db: Session = Depends(get_db)):
     task_info_create = task_request.task_info
-    def get_holidays_for_year_local(year: int): return crud.get_holiday_dates_for_year(db, year)
     try:
         initial_trigger_local_time, initial_status = calculate_initial_trigger_time(
-            task_info_create, get_holidays_for_year_local
+            task_info_create, crud.make_holiday_dates_getter(db)
         )
     except ValueError as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"任务配置错误: {str(e)}")
@@ -150,10 +149,9 @@ async def process_natural_language_request(
                 error_detail += "AI未提供通知渠道 (webhook_channel 或 email_channel)，或提供的结构不符合schema。"
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=error_detail)
         
-        def get_holidays_local_create(year: int): return crud.get_holiday_dates_for_year(db, year)
         try:
             initial_trigger_local_time, initial_status = calculate_initial_trigger_time(
-                task_info_create, get_holidays_local_create
+                task_info_create, crud.make_holiday_dates_getter(db)
             )
         except ValueError as e:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"CREATE_TASK: 配置在计算触发时间时出错: {str(e)}")
@@ -521,10 +519,9 @@ async def update_existing_task(task_id: str, task_update: schemas.TaskUpdateRequ
         update_data_for_crud_layer['task_info'] = merged_task_info_dict 
 
         # --- 重新计算触发时间和状态 ---
-        def get_holidays_for_year_local_update(year: int): return crud.get_holiday_dates_for_year(db, year)
         try:
             trigger_time_after_update, status_after_update = calculate_initial_trigger_time(
-                temp_task_info_for_recalc, get_holidays_for_year_local_update
+                temp_task_info_for_recalc, crud.make_holiday_dates_getter(db)
             )
             new_next_trigger_local_time_val = trigger_time_after_update
             new_status_val = status_after_update
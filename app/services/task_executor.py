@@ -1,5 +1,6 @@
 # app/services/task_executor.py
 from sqlalchemy.orm import Session
+import asyncio
 import datetime 
 
 from app import models, schemas, crud
@@ -10,7 +11,8 @@ from app.database import SessionLocal
 
 async def execute_task_by_id(task_id: str, scheduler_instance: 'app.services.task_scheduler.TaskSchedulerService'):
     """根据任务ID执行任务（发送通知，并为周期性任务重新调度）。"""
-    db: Session = SessionLocal() 
+    # 执行过程中会多次提交，内存中的属性值即为刚写入的值，无需在每次提交后重新从数据库加载
+    db: Session = SessionLocal(expire_on_commit=False) 
     task: Optional[models.ReminderTaskDB] = None
     try:
         task = crud.get_task(db, task_id) 
@@ -29,8 +31,7 @@ async def execute_task_by_id(task_id: str, scheduler_instance: 'app.services.tas
             return
 
         task.status = models.TaskStatusEnum.RUNNING
-        db.commit()
-        
+        # 先解析 task_info 再提交：下面的提交可能在线程池中与 Dify 请求并发执行，期间不再访问会话
         task_info_model = schemas.TaskInfo(**task.task_info) 
         base_reminder_content = "" # 这是不包含@信息的纯粹提醒内容
 
@@ -38,17 +39,24 @@ async def execute_task_by_id(task_id: str, scheduler_instance: 'app.services.tas
             print(f"任务 {task_id} 通过 Dify 生成内容。提示: {task_info_model.reminder_content[:30]}...")
             if settings.DIFY_API_KEY and settings.DIFY_BASE_URL: 
                 dify_user_id_for_generation = task_info_model.triggering_user_id or f"task_executor_{task_id}"
-                generated_content = await dify_client.generate_content_with_dify(
-                    prompt=task_info_model.reminder_content, 
-                    user_id=dify_user_id_for_generation 
+                # RUNNING 状态的提交在线程池中执行，与 Dify 网络请求重叠
+                loop = asyncio.get_running_loop()
+                _, generated_content = await asyncio.gather(
+                    loop.run_in_executor(None, db.commit),
+                    dify_client.generate_content_with_dify(
+                        prompt=task_info_model.reminder_content, 
+                        user_id=dify_user_id_for_generation 
+                    )
                 )
                 if generated_content and not generated_content.startswith("Dify"): 
                     base_reminder_content = generated_content
                 else: 
                     base_reminder_content = f"Dify内容生成失败({generated_content[:50]}...). 原始提示: {task_info_model.reminder_content}"
             else: 
+                db.commit()
                 base_reminder_content = f"Dify未配置。原始提示: {task_info_model.reminder_content}"
         else: 
+            db.commit()
             base_reminder_content = task_info_model.reminder_content
 
         notification_sent_successfully = False
@@ -73,7 +81,7 @@ async def execute_task_by_id(task_id: str, scheduler_instance: 'app.services.tas
         is_group_message_context = False
         at_user_id_for_payload: Optional[str] = None # 用于 AtWxIDList
         
-        if task_target_chat_id and "@chatroom" in task_target_chat_id: # 简单判断是否为群聊ID
+        if task_target_chat_id and task_target_chat_id.endswith("@chatroom"): # 群聊ID以 @chatroom 结尾
             is_group_message_context = True
             at_user_id_for_payload = task_triggering_user_id # 在群里@发起任务的人
 
@@ -116,18 +124,17 @@ async def execute_task_by_id(task_id: str, scheduler_instance: 'app.services.tas
         db.commit()
 
         if task.is_recurring and task_info_model.cron_config:
+            # 通知发送（尤其是 Dify 生成内容）可能耗时较长，这里需要重新读取当前时间作为计算基准
             base_for_next_calc_local = datetime.datetime.now() 
-            def get_holidays_for_year_local_exec(year_val: int): return crud.get_holiday_dates_for_year(db, year_val)
 
             next_trigger_local, next_status = get_next_cron_run_time(
                 cron_config=task_info_model.cron_config,
                 base_local_time=base_for_next_calc_local, 
-                holiday_dates_getter=get_holidays_for_year_local_exec
+                holiday_dates_getter=crud.make_holiday_dates_getter(db)
             )
             task.next_trigger_time = next_trigger_local 
             task.status = next_status 
             db.commit()
-            db.refresh(task) 
 
             if task.status == models.TaskStatusEnum.PENDING and task.next_trigger_time:
                 scheduler_instance.add_or_update_job_in_scheduler(task)
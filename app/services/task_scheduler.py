@@ -1,6 +1,8 @@
 # app/services/task_scheduler.py
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.executors.asyncio import AsyncIOExecutor
 from apscheduler.triggers.date import DateTrigger
+from apscheduler.jobstores.base import JobLookupError
 import datetime # 标准库
 
 from app.core.config import settings
@@ -15,7 +17,12 @@ class TaskSchedulerService:
     def __init__(self):
         if TaskSchedulerService._scheduler is None:
             # 不指定 timezone，APScheduler 默认使用系统本地时区
-            TaskSchedulerService._scheduler = AsyncIOScheduler()
+            # 任务函数均为协程，显式使用 AsyncIOExecutor 直接在事件循环中运行；
+            # coalesce=True 使停机期间错过的多次触发只补执行一次，避免重启后集中爆发
+            TaskSchedulerService._scheduler = AsyncIOScheduler(
+                executors={'default': AsyncIOExecutor()},
+                job_defaults={'coalesce': True, 'max_instances': 10, 'misfire_grace_time': 600}
+            )
             print(f"APScheduler 已使用系统本地时区初始化。")
 
     async def start(self):
@@ -31,6 +38,8 @@ class TaskSchedulerService:
                     models.ReminderTaskDB.next_trigger_time.isnot(None) # type: ignore
                 ).all()
                 print(f"发现 {len(tasks_to_schedule)} 个待调度 (PENDING) 任务。")
+                # 以暂停状态启动后再批量添加任务，避免每添加一个任务就唤醒一次调度循环
+                self._scheduler.start(paused=True)
                 for task in tasks_to_schedule:
                     self.add_or_update_job_in_scheduler(task)
                 
@@ -46,7 +55,7 @@ class TaskSchedulerService:
                     id='daily_maintenance_job', replace_existing=True, misfire_grace_time=3600
                 )
                 print("每日维护任务已添加。")
-                self._scheduler.start()
+                self._scheduler.resume()
                 print("任务调度器已启动。")
             finally:
                 db.close()
@@ -62,9 +71,10 @@ class TaskSchedulerService:
             return
         
         trigger_local_time = task.next_trigger_time # 这是 naive local time
+        current_local_time = datetime.datetime.now()
         
-        if trigger_local_time <= datetime.datetime.now(): # 比较 naive local times
-            print(f"任务 {task.id} 下次执行本地时间 {trigger_local_time.isoformat()} 已过 (当前 {datetime.datetime.now().isoformat()})。将尝试立即执行。")
+        if trigger_local_time <= current_local_time: # 比较 naive local times
+            print(f"任务 {task.id} 下次执行本地时间 {trigger_local_time.isoformat()} 已过 (当前 {current_local_time.isoformat()})。将尝试立即执行。")
 
         job_id = str(task.id)
         try:
@@ -82,35 +92,39 @@ class TaskSchedulerService:
     def remove_job_from_scheduler(self, task_id: str):
         job_id = str(task_id)
         try:
-            if self._scheduler.get_job(job_id):
-                self._scheduler.remove_job(job_id)
-                print(f"任务 {job_id} 已从调度器中移除。")
+            self._scheduler.remove_job(job_id)
+            print(f"任务 {job_id} 已从调度器中移除。")
+        except JobLookupError:
+            pass # 任务不在调度器中，无需移除
         except Exception as e:
             print(f"从调度器移除任务 {job_id} 失败: {e}")
     
     async def daily_maintenance_job(self):
-        current_local_time_str = datetime.datetime.now().isoformat()
-        print(f"[{current_local_time_str}] 开始执行每日维护任务...")
+        current_local_time = datetime.datetime.now()
+        print(f"[{current_local_time.isoformat()}] 开始执行每日维护任务...")
         db = SessionLocal()
         try:
-            current_year = datetime.datetime.now().year
+            current_year = current_local_time.year
             await holiday_service.ensure_calendar_data_exists(db, current_year + 1, force=False)
 
             print("检查 PENDING_CALCULATION 状态的任务...")
             tasks_to_recalculate = crud.get_tasks_for_recalculation(db)
             print(f"发现 {len(tasks_to_recalculate)} 个待重新计算的任务。")
+            # 日历数据已在上方同步完毕，所有待计算任务共享同一份按年份缓存的查询结果
+            get_holidays_for_year_local = crud.make_holiday_dates_getter(db)
             
             for task_db in tasks_to_recalculate:
                 print(f"重新计算任务 {task_db.id} ({task_db.task_name})...")
                 try:
-                    task_info_model = schemas.TaskInfo(**task_db.task_info)
-                    if task_info_model.is_recurring and task_info_model.cron_config:
-                        def get_holidays_for_year_local(year_val: int): return crud.get_holiday_dates_for_year(db, year_val)
-                        
+                    # task_info 在写入时已经过完整校验，这里只需要 cron_config，
+                    # 因此直接读取字典并仅校验 CronConfig（用于解析其中的日期时间字段）
+                    cron_config_data = task_db.task_info.get("cron_config")
+                    if task_db.task_info.get("is_recurring") and cron_config_data:
+                        cron_config = schemas.CronConfig(**cron_config_data)
                         base_for_recalc_local = task_db.next_trigger_time or datetime.datetime.now()
                         
                         next_trigger_local, next_status = get_next_cron_run_time(
-                            cron_config=task_info_model.cron_config,
+                            cron_config=cron_config,
                             base_local_time=base_for_recalc_local - datetime.timedelta(minutes=1),
                             holiday_dates_getter=get_holidays_for_year_local
                         )
@@ -1,5 +1,6 @@
 # app/utils/date_calculator.py
 import datetime # 标准库
+import functools
 import re
 from typing import Optional, List, Tuple, Callable, Dict
 from croniter import croniter
@@ -8,9 +9,16 @@ from lunardate import LunarDate # 导入lunardate库
 from app.schemas import CronConfig, CountdownConfig, OneTimeSpecificConfig, TaskInfoCreate
 from app.models import HolidayDateDB, TaskStatusEnum
 
+_COUNTDOWN_RE = re.compile(r'^((?P<days>\d+)d)?((?P<hours>\d+)h)?((?P<minutes>\d+)m)?((?P<seconds>\d+)s)?$', re.IGNORECASE)
+
+@functools.lru_cache(maxsize=128)
+def _get_cron_iter(cron_expression: str) -> croniter:
+    """按表达式缓存 croniter 对象，表达式字段只解析一次。对象是有状态的，使用前须先 set_current。"""
+    return croniter(cron_expression)
+
 def parse_countdown_duration(duration_str: str) -> datetime.timedelta:
     """解析倒计时字符串 (如 '1d2h3m4s') 为 timedelta 对象。"""
-    match = re.match(r'^((?P<days>\d+)d)?((?P<hours>\d+)h)?((?P<minutes>\d+)m)?((?P<seconds>\d+)s)?$', duration_str.lower())
+    match = _COUNTDOWN_RE.match(duration_str)
     if not match: raise ValueError(f"无效倒计时格式: {duration_str}")
     parts = match.groupdict()
     time_params = {name: int(param) for name, param in parts.items() if param}
@@ -68,11 +76,21 @@ def get_next_cron_run_time(
     try:
         # 对于农历任务，cron_expression 的日月字段应为 '*'，时间字段正常
         # croniter 用于生成每日的候选时间点
-        iter_cron = croniter(cron_config.cron_expression, base_local_time)
+        iter_cron = _get_cron_iter(cron_config.cron_expression)
+        iter_cron.set_current(base_local_time)
     except ValueError as e_croniter: 
         print(f"Cron表达式格式错误: {cron_config.cron_expression} - {e_croniter}")
         return None, TaskStatusEnum.FAILED
 
+    def skip_to_next_day(run_local: datetime.datetime) -> None:
+        # 农历与 limit_days 均按整天判断，某天被排除后该天其余候选时间点也必然被排除，
+        # 直接把迭代器移到次日零点前一秒，避免逐分钟/逐小时地遍历已确认无效的日期
+        next_day_start = datetime.datetime.combine(run_local.date() + datetime.timedelta(days=1), datetime.time.min)
+        iter_cron.set_current(next_day_start - datetime.timedelta(seconds=1))
+
+    # 每个年份的日历数据只建一次索引，键为 yyyymmdd 整数，避免对每个候选日期格式化字符串并线性查找
+    holiday_index_by_year: Dict[int, Dict[int, HolidayDateDB]] = {}
+
     for attempt in range(max_attempts): 
         try:
             next_run_local = iter_cron.get_next(datetime.datetime) 
@@ -86,22 +104,24 @@ def get_next_cron_run_time(
         if start_dt_local and next_run_local < start_dt_local:
             continue 
 
-        target_date_str_local = next_run_local.strftime("%Y-%m-%d")
         needs_calendar_data_for_limit_days = bool(cron_config.limit_days)
         current_day_holiday_info: Optional[HolidayDateDB] = None
 
         if needs_calendar_data_for_limit_days: 
-            year_data_local = holiday_dates_getter(next_run_local.year) 
-            if not year_data_local: 
-                print(f"警告: 年份 {next_run_local.year} 日历数据缺失 (cron: {cron_config.cron_expression}, 检查日期: {target_date_str_local})。任务将进入待计算状态。")
+            year_index_local = holiday_index_by_year.get(next_run_local.year)
+            if year_index_local is None:
+                year_index_local = {
+                    day_obj.year * 10000 + day_obj.month * 100 + day_obj.day: day_obj
+                    for day_obj in holiday_dates_getter(next_run_local.year)
+                }
+                holiday_index_by_year[next_run_local.year] = year_index_local
+            if not year_index_local: 
+                print(f"警告: 年份 {next_run_local.year} 日历数据缺失 (cron: {cron_config.cron_expression}, 检查日期: {next_run_local:%Y-%m-%d})。任务将进入待计算状态。")
                 return next_run_local, TaskStatusEnum.PENDING_CALCULATION 
 
-            for day_obj in year_data_local:
-                if day_obj.date == target_date_str_local:
-                    current_day_holiday_info = day_obj
-                    break
+            current_day_holiday_info = year_index_local.get(next_run_local.year * 10000 + next_run_local.month * 100 + next_run_local.day)
             if not current_day_holiday_info: 
-                print(f"警告: 日期 {target_date_str_local} 详细日历信息缺失。任务将进入待计算状态。")
+                print(f"警告: 日期 {next_run_local:%Y-%m-%d} 详细日历信息缺失。任务将进入待计算状态。")
                 return next_run_local, TaskStatusEnum.PENDING_CALCULATION
 
         # --- 农历日期判断逻辑 (已修正) ---
@@ -122,21 +142,23 @@ def get_next_cron_run_time(
                 # 检查转换后的农历月和日是否与配置中指定的农历月和日匹配
                 if not (lunar_date_of_next_run.month == target_lunar_month and \
                         lunar_date_of_next_run.day == target_lunar_day):
-                    continue # 如果不匹配，则继续查找下一个由croniter生成的公历日期
+                    skip_to_next_day(next_run_local)
+                    continue # 如果不匹配，则从次日开始继续查找由croniter生成的公历日期
             except ValueError: 
                 print(f"错误: 农历任务的 lunar_month ('{cron_config.lunar_month}') 或 lunar_day ('{cron_config.lunar_day}') 不是有效的整数。")
                 return None, TaskStatusEnum.FAILED
             except Exception as e_lunar: 
                 error_message_lower = str(e_lunar).lower()
                 if "date" in error_message_lower and ("exist" in error_message_lower or "invalid" in error_message_lower or "range" in error_message_lower):
-                    print(f"农历日期相关错误 (公历 {target_date_str_local}, cron='{cron_config.cron_expression}'): {e_lunar} (提示：可能日期不存在或无效)")
+                    print(f"农历日期相关错误 (公历 {next_run_local:%Y-%m-%d}, cron='{cron_config.cron_expression}'): {e_lunar} (提示：可能日期不存在或无效)")
                 else: 
-                    print(f"处理农历日期时发生意外错误 (公历 {target_date_str_local}, cron='{cron_config.cron_expression}'): {e_lunar}")
+                    print(f"处理农历日期时发生意外错误 (公历 {next_run_local:%Y-%m-%d}, cron='{cron_config.cron_expression}'): {e_lunar}")
+                skip_to_next_day(next_run_local)
                 continue 
         
         if cron_config.limit_days: 
             if not current_day_holiday_info: 
-                print(f"警告: 日期 {target_date_str_local} 详细日历信息缺失，无法应用 limit_days。任务将进入待计算状态。")
+                print(f"警告: 日期 {next_run_local:%Y-%m-%d} 详细日历信息缺失，无法应用 limit_days。任务将进入待计算状态。")
                 return next_run_local, TaskStatusEnum.PENDING_CALCULATION 
 
             day_matched_limit = False 
@@ -148,6 +170,7 @@ def get_next_cron_run_time(
                 if limit_type == "WEEKDAY_ONLY" and 1 <= next_run_local.isoweekday() <= 5: day_matched_limit = True; break 
             
             if not day_matched_limit: 
+                skip_to_next_day(next_run_local)
                 continue 
 
         return next_run_local, TaskStatusEnum.PENDING
@@ -18,7 +18,15 @@ DIFY_BASE_URL = os.getenv("DIFY_BASE_URL", "https://api.dify.ai/v1")
 
 # Application Configuration
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
-MAX_FILE_SIZE_MB = os.getenv("MAX_FILE_SIZE_MB", "15") # Kept for DifyHandler and MessageProcessor initialization
+
+# MAX_FILE_SIZE_MB: Read and validate once, exposed as int for DifyHandler and MessageProcessor
+max_file_size_mb_str = os.getenv("MAX_FILE_SIZE_MB", "15")
+try:
+    MAX_FILE_SIZE_MB = int(max_file_size_mb_str)
+    if MAX_FILE_SIZE_MB <= 0:
+        raise ValueError("MAX_FILE_SIZE_MB 必须是正整数。")
+except ValueError as e:
+    raise ValueError(f"错误: MAX_FILE_SIZE_MB ('{max_file_size_mb_str}') 不是一个有效的正整数。请检查 .env 文件。Details: {e}")
 
 DIFY_USER_ID_PREFIX = os.getenv("DIFY_USER_ID_PREFIX", "wechat_") # Retained from original
 
@@ -31,6 +39,14 @@ try:
 except ValueError as e:
     raise ValueError(f"错误: MESSAGE_BATCH_DELAY_SECONDS ('{message_batch_delay_seconds_str}') 不是一个有效的非负整数。请检查 .env 文件。Details: {e}")
 
+# DIFY_STT_NATIVE_FORMATS: Dify STT 可直接识别的微信语音格式 (逗号分隔，如 "amr")，这些格式跳过 ffmpeg 转 MP3
+DIFY_STT_NATIVE_FORMATS = frozenset(
+    fmt.strip().lower() for fmt in os.getenv("DIFY_STT_NATIVE_FORMATS", "").split(",") if fmt.strip()
+)
+
+# DIFY_STREAMING_REPLY: 为 true 时以 streaming 模式调用 Dify，并按句子分段把回复陆续发送到微信
+DIFY_STREAMING_REPLY = os.getenv("DIFY_STREAMING_REPLY", "false").lower() == "true"
+
 
 required_configs = {
     "WECHAT_API_BASE_URL": WECHAT_API_BASE_URL,
@@ -44,13 +60,4 @@ required_configs = {
 missing_configs = [key for key, value in required_configs.items() if value is None]
 
 if missing_configs:
-    raise ValueError(f"错误：以下必要的配置项缺失，请检查.env 文件: {', '.join(missing_configs)}")
-
-# Validate MAX_FILE_SIZE_MB format early
-try:
-    # Ensure it's an int, it will be used as int(MAX_FILE_SIZE_MB) later
-    _ = int(MAX_FILE_SIZE_MB) 
-    if int(MAX_FILE_SIZE_MB) <=0:
-        raise ValueError("MAX_FILE_SIZE_MB 必须是正整数。")
-except ValueError as e:
-    raise ValueError(f"错误: MAX_FILE_SIZE_MB ('{MAX_FILE_SIZE_MB}') 不是一个有效的正整数。请检查 .env 文件。Details: {e}")
\ No newline at end of file
+    raise ValueError(f"错误：以下必要的配置项缺失，请检查.env 文件: {', '.join(missing_configs)}")
\ No newline at end of file
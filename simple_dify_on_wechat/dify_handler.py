@@ -1,66 +1,130 @@
 # dify_handler.py
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from requests_toolbelt import MultipartEncoder
+import orjson
 import logging
 import os
+import functools
 from urllib.parse import urlparse
+from types import MappingProxyType
 import mimetypes
 
 from config import DIFY_API_KEY, DIFY_BASE_URL, MAX_FILE_SIZE_MB
+from utils.log_utils import short_repr
 
 logger = logging.getLogger(__name__)
 
+DIFY_STT_LIMIT_BYTES = 15 * 1024 * 1024  # Dify STT通常的限制，具体请查阅Dify文档
+
+mimetypes.init() # 模块加载时预先初始化 mimetypes 的映射表
+
+# 部分系统的 mime 映射表中缺少的扩展名，在模块加载时注册到 mimetypes；系统已有的映射保持不变
+_EXTRA_MIME_TYPES = {
+    '.webp': 'image/webp',
+    '.text': 'text/plain',
+    '.m4a': 'audio/m4a',
+    '.webm': 'audio/webm',
+    '.mpga': 'audio/mpeg',
+    # 微信语音常见格式
+    '.silk': 'audio/silk', # 非标准，但常见
+    '.amr': 'audio/amr',   # 标准
+}
+for _ext, _mime_type in _EXTRA_MIME_TYPES.items():
+    if mimetypes.guess_type('file' + _ext)[0] is None:
+        mimetypes.add_type(_mime_type, _ext)
+
+@functools.lru_cache(maxsize=256)
+def _mime_for_ext(ext: str):
+    # 按小写扩展名缓存 mimetypes 的查询结果；文件名本身 (如带时间戳/随机串) 每次都不同，不适合作为缓存键
+    return mimetypes.guess_type('file' + ext)[0]
+
+def _guess_mime(name_hint: str, default: str = 'application/octet-stream') -> str:
+    """
+    根据文件名猜测 MIME 类型，未命中时返回 default。
+    """
+    mime_type = _mime_for_ext(os.path.splitext(name_hint)[1].lower())
+    if mime_type:
+        return mime_type
+    logger.info(f"无法从文件名 '{name_hint}' 准确猜测MIME类型，已设置为 '{default}'")
+    return default
+
+class _BufferReader:
+    """
+    在 bytes/bytearray 上按块读取的只读文件对象。
+    io.BytesIO(bytearray) 会复制整个缓冲区，这里通过 memoryview 切片读取，MultipartEncoder 每次只复制一个块。
+    """
+    def __init__(self, buffer):
+        self._view = memoryview(buffer)
+        self._pos = 0
+
+    @property
+    def len(self):
+        # MultipartEncoder 通过 len 判断剩余待发送的字节数，必须随读取递减
+        return len(self._view) - self._pos
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else min(self._pos + size, len(self._view))
+        chunk = self._view[self._pos:end].tobytes()
+        self._pos = end
+        return chunk
+
 class DifyHandler:
     def __init__(self):
         self.api_key = DIFY_API_KEY
         self.base_url = DIFY_BASE_URL
-        self.headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-        self.upload_auth_headers = {
-            "Authorization": f"Bearer {self.api_key}"
-        }
-        try:
-            self.max_file_size_bytes = int(MAX_FILE_SIZE_MB) * 1024 * 1024
-        except ValueError:
-            logger.error(f"Invalid MAX_FILE_SIZE_MB value in config: {MAX_FILE_SIZE_MB}. Defaulting to 15MB.")
-            self.max_file_size_bytes = 15 * 1024 * 1024
+        # 复用同一个 Session (keep-alive + 连接池)，避免每次请求都重新进行 TCP/TLS 握手
+        # Authorization 设置在 session 上，所有请求自动携带
+        self.session = requests.Session()
+        self.session.headers.update({"Authorization": f"Bearer {self.api_key}"})
+        retry_policy = Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        self.session.mount(self.base_url, HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retry_policy))
+        # 只读的默认请求头，每次请求直接复用，只有调用方传入 headers 覆盖时才合并出新 dict
+        self._json_headers = MappingProxyType({"Content-Type": "application/json"})
+        self.max_file_size_bytes = MAX_FILE_SIZE_MB * 1024 * 1024
+        # STT 实际生效的大小上限和对应的 MB 数只依赖配置，初始化时计算一次
+        self._stt_limit_bytes = min(self.max_file_size_bytes, DIFY_STT_LIMIT_BYTES)
+        self._stt_limit_mb = self._stt_limit_bytes // (1024 * 1024)
 
     def _make_request(self, method, endpoint, **kwargs):
         url = f"{self.base_url}{endpoint}"
         timeout = kwargs.pop('timeout', (10, 180))
         
-        current_headers = self.headers.copy() # Start with a copy
-        if 'files' in kwargs:
-            # For multipart/form-data, requests sets Content-Type, so remove it from our default headers
-            # Only keep Authorization from upload_auth_headers if it's different or specific
-            current_headers = self.upload_auth_headers.copy() 
-            if "Content-Type" in current_headers: # Should not be there for upload_auth_headers
-                del current_headers["Content-Type"]
+        if isinstance(kwargs.get('data'), MultipartEncoder):
+            # 流式 multipart 请求体 (文件上传、语音转文字)：Content-Type (含 boundary) 由 encoder 提供；Authorization 来自 session
+            current_headers = {"Content-Type": kwargs['data'].content_type}
+        else:
+            # JSON 请求：send_chat_message 以 data= 传入 orjson 序列化好的 bytes，这里只需补上 Content-Type
+            current_headers = self._json_headers
         
-        if 'headers' in kwargs: # Allow overriding headers
-            final_headers = {**current_headers, **kwargs.pop('headers')}
+        override_headers = kwargs.pop('headers', None) # Allow overriding headers
+        if override_headers:
+            final_headers = {**current_headers, **override_headers}
         else:
             final_headers = current_headers
 
         try:
-            # logger.debug(f"Dify Request: {method} {url} Headers: {final_headers} Payload: {str(kwargs.get('json', kwargs.get('data')))[:200]}")
-            response = requests.request(method, url, headers=final_headers, timeout=timeout, **kwargs)
+            # logger.debug(f"Dify Request: {method} {url} Headers: {final_headers} Payload: {short_repr(kwargs.get('data'))}")
+            response = self.session.request(method, url, headers=final_headers, timeout=timeout, **kwargs)
             response.raise_for_status()
             
             content_type = response.headers.get("Content-Type", "")
             if "application/json" in content_type:
-                return response.json()
+                return orjson.loads(response.content)
             elif "text/event-stream" in content_type:
                 return response
             elif "audio/" in content_type:
-                return response.content, content_type
+                # 在此 try 内分块读入 bytearray：读取中途的 ChunkedEncodingError/ConnectionError 仍由下面的 except 转为错误字典
+                audio_bytes = bytearray()
+                for audio_chunk in response.iter_content(chunk_size=64 * 1024):
+                    audio_bytes += audio_chunk
+                return audio_bytes, content_type
             else:
                 if response.status_code == 201 and method.upper() == "POST" and endpoint == "/files/upload":
                     try:
-                        return response.json()
-                    except json.JSONDecodeError:
+                        return orjson.loads(response.content)
+                    except orjson.JSONDecodeError:
                         logger.warning(f"Dify file upload returned 201 but response was not JSON: {response.text[:200]}")
                         return {"id": None, "name": None, "warning": "Response not JSON but status 201"}
                 logger.warning(f"Dify API response with unhandled Content-Type '{content_type}': {response.text[:200]}")
@@ -68,10 +132,11 @@ class DifyHandler:
         except requests.exceptions.HTTPError as e:
             error_text = e.response.text
             logger.error(f"Dify API HTTP 错误: {e.response.status_code} - {error_text[:500]}")
-            error_details = {"error": str(e), "status_code": e.response.status_code, "details_text": error_text}
+            # http_error 标记 status_code 来自 Dify 的 HTTP 响应，与本地参数校验等返回的错误字典区分开
+            error_details = {"error": str(e), "status_code": e.response.status_code, "details_text": error_text, "http_error": True}
             try:
-                error_details["details_json"] = e.response.json()
-            except json.JSONDecodeError:
+                error_details["details_json"] = orjson.loads(e.response.content)
+            except orjson.JSONDecodeError:
                 logger.debug(f"Dify API HTTP 错误响应不是有效的JSON: {error_text[:200]}")
             return error_details
         except requests.exceptions.Timeout:
@@ -98,9 +163,29 @@ class DifyHandler:
         
         if files: 
             payload["files"] = files 
-            logger.debug(f"Dify 聊天消息将包含文件引用: {files}")
+            logger.debug("Dify 聊天消息将包含文件引用: %s", files)
+
+        # orjson 直接序列化为 UTF-8 字节 (中文不做 \u 转义)，Content-Type 已在 self._json_headers 中设置
+        return self._make_request("POST", endpoint, data=orjson.dumps(payload), stream=stream)
 
-        return self._make_request("POST", endpoint, json=payload, stream=stream)
+    def iter_chat_stream_events(self, response):
+        """
+        逐条解析 streaming 模式下 Dify 返回的 SSE 事件 (每个 `data: {...}` 行为一个 JSON 事件)，遍历结束后关闭响应。
+        """
+        try:
+            # 按原始字节读取：SSE 响应头通常不带 charset，decode_unicode 会误用 ISO-8859-1；orjson 直接解析 UTF-8 字节
+            for line in response.iter_lines():
+                if not line or not line.startswith(b"data:"):
+                    continue
+                try:
+                    yield orjson.loads(line[5:])
+                except orjson.JSONDecodeError:
+                    logger.warning(f"无法解析 Dify 流式事件: {line[:200]!r}")
+        except requests.exceptions.RequestException as e:
+            logger.error(f"读取 Dify 流式响应时出错: {e}")
+            yield {"event": "error", "message": str(e)}
+        finally:
+            response.close()
 
     def upload_file_to_dify(self, user_id, file_bytes, file_name_hint):
         # ... (此方法保持不变) ...
@@ -113,86 +198,57 @@ class DifyHandler:
             logger.error(f"待上传Dify文件大小 ({len(file_bytes)} bytes) 超出限制 ({self.max_file_size_bytes} bytes): {file_name_hint}")
             return {"error": f"文件大小超出应用配置限制 ({MAX_FILE_SIZE_MB}MB)", "status_code": 413}
 
-        mime_type, _ = mimetypes.guess_type(file_name_hint)
-        if not mime_type: 
-            name_lower = file_name_hint.lower()
-            if name_lower.endswith(('.png')): mime_type = 'image/png'
-            elif name_lower.endswith(('.jpg', '.jpeg')): mime_type = 'image/jpeg'
-            elif name_lower.endswith(('.gif')): mime_type = 'image/gif'
-            elif name_lower.endswith(('.webp')): mime_type = 'image/webp'
-            elif name_lower.endswith(('.txt', '.text')): mime_type = 'text/plain'
-            elif name_lower.endswith(('.pdf')): mime_type = 'application/pdf'
-            elif name_lower.endswith(('.csv')): mime_type = 'text/csv'
-            else: mime_type = 'application/octet-stream'
-            logger.info(f"无法从文件名 '{file_name_hint}' 准确猜测MIME类型，已设置为 '{mime_type}'")
+        mime_type = _guess_mime(file_name_hint)
         
-        files_payload = {'file': (file_name_hint, file_bytes, mime_type)}
-        data_payload = {'user': user_id} 
+        # MultipartEncoder 按块读取并发送请求体，不会在内存中再拼出一份完整的 multipart 数据；文件内容也直接从原缓冲区切片读取
+        multipart_body = MultipartEncoder(fields={'user': user_id, 'file': (file_name_hint, _BufferReader(file_bytes), mime_type)})
         
         logger.info(f"准备上传文件到 Dify 内部存储: 文件名提示='{file_name_hint}', User='{user_id}', 大小={len(file_bytes)} bytes, ContentType='{mime_type}'")
         
-        response_data = self._make_request("POST", endpoint, data=data_payload, files=files_payload) 
+        response_data = self._make_request("POST", endpoint, data=multipart_body) 
         
         if isinstance(response_data, dict) and "id" in response_data: 
             logger.info(f"文件成功上传到Dify: ID='{response_data.get('id')}', Name='{response_data.get('name')}'")
             return response_data 
         else: 
-            logger.error(f"上传文件到Dify失败或响应格式不正确: {str(response_data)[:300]}")
+            logger.error(f"上传文件到Dify失败或响应格式不正确: {short_repr(response_data)}")
             if isinstance(response_data, dict) and "error" in response_data:
                 return response_data 
-            return {"error": "上传文件到Dify失败或响应格式不正确", "details": str(response_data)[:300]}
+            return {"error": "上传文件到Dify失败或响应格式不正确", "details": short_repr(response_data)}
 
     def audio_to_text(self, user_id: str, audio_file_path: str): # <--- 修改点：参数变为 audio_file_path
         """
         将本地音频文件通过Dify API转换为文本。
         """
         endpoint = "/audio-to-text"
-        if not os.path.exists(audio_file_path):
+        try:
+            file_size = os.stat(audio_file_path).st_size # 一次 stat 同时完成存在性检查和获取大小
+        except FileNotFoundError:
             logger.error(f"Dify Audio-to-Text: 音频文件路径不存在 '{audio_file_path}'。")
             return {"error": "音频文件路径不存在", "status_code": 400}
         
-        file_size = os.path.getsize(audio_file_path)
         audio_file_name_hint = os.path.basename(audio_file_path) # 从路径获取文件名提示
 
-        dify_stt_specific_limit = 15 * 1024 * 1024  # Dify STT通常的限制，具体请查阅Dify文档
-        effective_limit = min(self.max_file_size_bytes, dify_stt_specific_limit)
-
         if file_size == 0:
             logger.error(f"Dify Audio-to-Text: 音频文件为空 '{audio_file_path}'。")
             return {"error": "音频文件内容为空", "status_code": 400}
 
-        if file_size > effective_limit:
-            logger.error(f"STT 音频文件大小 ({file_size} bytes) 超出限制 ({effective_limit // (1024*1024)}MB): {audio_file_name_hint}")
-            return {"error": f"STT 音频文件大小超出限制 ({effective_limit // (1024*1024)}MB)", "status_code": 413}
-
-        mime_type, _ = mimetypes.guess_type(audio_file_name_hint)
-        if not mime_type:
-            name_lower = audio_file_name_hint.lower()
-            if name_lower.endswith('.wav'): mime_type = 'audio/wav'
-            elif name_lower.endswith('.mp3'): mime_type = 'audio/mpeg'
-            elif name_lower.endswith('.m4a'): mime_type = 'audio/m4a'
-            elif name_lower.endswith('.webm'): mime_type = 'audio/webm'
-            elif name_lower.endswith('.mp4'): mime_type = 'audio/mp4'
-            elif name_lower.endswith('.mpeg'): mime_type = 'audio/mpeg'
-            elif name_lower.endswith('.mpga'): mime_type = 'audio/mpeg'
-            # 补充 silk 和 amr 作为常见微信语音格式的MIME猜测
-            elif name_lower.endswith('.silk'): mime_type = 'audio/silk' # 非标准，但常见
-            elif name_lower.endswith('.amr'): mime_type = 'audio/amr'   # 标准
-            else: mime_type = 'application/octet-stream'
-            logger.info(f"无法从音频文件名 '{audio_file_name_hint}' 准确猜测MIME类型，已设置为 '{mime_type}'")
+        if file_size > self._stt_limit_bytes:
+            logger.error(f"STT 音频文件大小 ({file_size} bytes) 超出限制 ({self._stt_limit_mb}MB): {audio_file_name_hint}")
+            return {"error": f"STT 音频文件大小超出限制 ({self._stt_limit_mb}MB)", "status_code": 413}
+
+        mime_type = _guess_mime(audio_file_name_hint)
         
-        # 构造 files 和 data payload
-        # files={'file': (文件名, 文件对象, 内容类型)}
-        # data={'user': 用户ID}
+        # 构造流式 multipart 请求体: user=用户ID, file=(文件名, 文件对象, 内容类型)
+        # 直接传入文件对象，由 encoder 边读边发，不会把整个文件读入内存
         try:
             with open(audio_file_path, 'rb') as audio_file:
-                files_payload = {'file': (audio_file_name_hint, audio_file, mime_type)}
-                data_payload = {'user': user_id}
+                multipart_body = MultipartEncoder(fields={'user': user_id, 'file': (audio_file_name_hint, audio_file, mime_type)})
             
                 logger.info(f"发送本地音频文件到 Dify Audio-to-Text API: user_id='{user_id}', 文件路径='{audio_file_path}', 文件名提示='{audio_file_name_hint}', 大小={file_size} bytes, ContentType='{mime_type}'")
                 
                 # 使用 _make_request 发送，它会处理headers
-                stt_response = self._make_request("POST", endpoint, data=data_payload, files=files_payload)
+                stt_response = self._make_request("POST", endpoint, data=multipart_body)
         except IOError as e:
             logger.error(f"读取本地音频文件失败 '{audio_file_path}': {e}")
             return {"error": f"读取本地音频文件失败: {e}", "status_code": 500}
@@ -205,7 +261,7 @@ class DifyHandler:
             logger.info(f"Dify Audio-to-Text 成功: '{stt_response['text'][:50]}...'")
             return stt_response
         else:
-            logger.error(f"Dify Audio-to-Text 失败或响应格式不正确: {str(stt_response)[:300]}")
+            logger.error(f"Dify Audio-to-Text 失败或响应格式不正确: {short_repr(stt_response)}")
             if isinstance(stt_response, dict) and "error" in stt_response:
                 return stt_response # 返回 _make_request 构造的错误字典
-            return {"error": "Dify Audio-to-Text失败或响应格式不正确", "details": str(stt_response)[:300]}
\ No newline at end of file
+            return {"error": "Dify Audio-to-Text失败或响应格式不正确", "details": short_repr(stt_response)}
\ No newline at end of file
@@ -5,12 +5,15 @@ import signal
 import threading
 import base64 
 import requests 
-from collections import defaultdict 
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Optional
 
-from config import LOG_LEVEL, WECHAT_BOT_WXID, MESSAGE_BATCH_DELAY_SECONDS 
+from config import LOG_LEVEL, WECHAT_BOT_WXID, MESSAGE_BATCH_DELAY_SECONDS, DIFY_STREAMING_REPLY 
 from utils.converters import url_to_base64 # 确保此工具函数可用
+from utils.log_utils import short_repr
 
-from wechat_client import WeChatClient
+from wechat_client import WeChatClient, WeChatMessage
 from dify_handler import DifyHandler
 from message_processor import MessageProcessor
 
@@ -20,6 +23,19 @@ logger = logging.getLogger(__name__)
 
 shutdown_event = threading.Event()
 
+# 批处理消息的 Dify 调用均为网络 I/O，使用固定大小的线程池执行，线程数不随联系人/批次数量增长
+BATCH_WORKER_COUNT = 16
+# 联系人缓冲区锁按 key 哈希分片，锁的数量固定，不会随联系人数量无限增长
+LOCK_SHARD_COUNT = 64
+# 同一条回复中的多张图片并行下载；单独的线程池，避免批处理线程等待排在自己后面的任务
+IMAGE_DOWNLOAD_WORKER_COUNT = 4
+
+@dataclass
+class ContactState:
+    """单个联系人 (好友或群) 的批处理状态：待处理消息缓冲区和批次到期时间。"""
+    buffer: List[WeChatMessage] = field(default_factory=list)
+    deadline: Optional[float] = None # time.monotonic() 时间点；None 表示已提交到线程池
+
 class Application:
     def __init__(self):
         logger.info("正在初始化应用程序...")
@@ -27,57 +43,104 @@ class Application:
         self.message_processor = MessageProcessor(self.dify_handler)
         self.wechat_client = WeChatClient(message_callback=self.on_wechat_message_received_sync)
         
-        self.message_buffers = defaultdict(list)
-        self.user_timers = {} 
-        self.buffer_locks = defaultdict(threading.Lock) 
+        self.contacts = {} # wechat_contact_key -> ContactState，读写均在对应分片锁内进行
+        self._locks = [threading.Lock() for _ in range(LOCK_SHARD_COUNT)]
+        self.batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKER_COUNT, thread_name_prefix="dify")
+        # 下载 Dify 回复中的图片：独立的 Session (不带 Dify 的 Authorization)，复用到同一图床的连接
+        self.download_session = requests.Session()
+        self.download_executor = ThreadPoolExecutor(max_workers=IMAGE_DOWNLOAD_WORKER_COUNT, thread_name_prefix="img")
+        # 单个后台调度线程负责检查到期批次，替代每条消息一个 threading.Timer
+        # 调度线程在 _dispatch_cond 上睡眠到最近的到期时间；出现新批次时被唤醒重新计算
+        self._dispatch_cond = threading.Condition()
+        self._dispatch_wakeup = False
+        self._dispatcher_thread = threading.Thread(target=self._dispatch_loop, name="batch-dispatcher", daemon=True)
+        self._dispatcher_thread.start()
 
         logger.info(f"应用程序初始化完成。消息批处理延迟: {MESSAGE_BATCH_DELAY_SECONDS}秒。")
 
+    def _lock_for(self, wechat_contact_key):
+        # 同一联系人总是映射到同一把锁；不同联系人偶尔共用一把锁也只是短暂等待，不影响正确性
+        return self._locks[hash(wechat_contact_key) % LOCK_SHARD_COUNT]
+
     def on_wechat_message_received_sync(self, wechat_msg):
-        logger.debug(f"原始微信消息进入批处理逻辑: ID={wechat_msg.get('id')}, 类型={wechat_msg.get('type')}")
+        logger.debug("原始微信消息进入批处理逻辑: ID=%s, 类型=%s", wechat_msg.id, wechat_msg.type)
 
         if not self.message_processor.should_process_wechat_message(wechat_msg):
             return
 
-        wechat_contact_key = wechat_msg.get("room_id") if wechat_msg.get("is_group") else wechat_msg.get("sender_id")
+        wechat_contact_key = wechat_msg.room_id if wechat_msg.is_group else wechat_msg.sender_id
         if not wechat_contact_key:
             logger.error("无法确定消息的 contact_key (room_id/sender_id)，无法进行批处理。")
             return
 
-        with self.buffer_locks[wechat_contact_key]: 
-            self.message_buffers[wechat_contact_key].append(wechat_msg)
-            logger.info(f"消息 {wechat_msg.get('id')} 已添加到 {wechat_contact_key} 的缓冲区。"
-                        f"当前数量: {len(self.message_buffers[wechat_contact_key])}")
-
-            if wechat_contact_key in self.user_timers:
-                timer = self.user_timers.pop(wechat_contact_key, None) 
-                if timer:
-                    timer.cancel()
-                    logger.debug(f"已取消 {wechat_contact_key} 的现有计时器。")
-            
-            new_timer = threading.Timer(
-                MESSAGE_BATCH_DELAY_SECONDS,
-                self._trigger_process_batched_messages, 
-                args=[wechat_contact_key]
-            )
-            self.user_timers[wechat_contact_key] = new_timer
-            new_timer.daemon = True 
-            new_timer.start()
-            logger.debug(f"已为 {wechat_contact_key} 启动新的 {MESSAGE_BATCH_DELAY_SECONDS} 秒计时器。")
+        with self._lock_for(wechat_contact_key): 
+            state = self.contacts.get(wechat_contact_key)
+            is_new_batch = state is None
+            if is_new_batch:
+                state = self.contacts[wechat_contact_key] = ContactState()
+            state.buffer.append(wechat_msg)
+            logger.info(f"消息 {wechat_msg.id} 已添加到 {wechat_contact_key} 的缓冲区。"
+                        f"当前数量: {len(state.buffer)}")
+
+            # 每条新消息都会顺延批次到期时间；已提交到线程池 (deadline 为 None) 的批次不再顺延，新消息会被该批次一并取走
+            if is_new_batch or state.deadline is not None:
+                state.deadline = time.monotonic() + MESSAGE_BATCH_DELAY_SECONDS
+                logger.debug("%s 的批次将在 %s 秒后到期。", wechat_contact_key, MESSAGE_BATCH_DELAY_SECONDS)
+
+        # 只有新批次可能比调度线程当前等待的到期时间更早；顺延已有批次无需唤醒，到期检查时会重新读取 deadline
+        if is_new_batch:
+            self._wake_dispatcher()
+
+    def _wake_dispatcher(self):
+        with self._dispatch_cond:
+            self._dispatch_wakeup = True
+            self._dispatch_cond.notify()
+
+    def _dispatch_loop(self):
+        while not shutdown_event.is_set():
+            now = time.monotonic()
+            next_deadline = None
+            for wechat_contact_key, state in list(self.contacts.items()):
+                deadline = state.deadline
+                if deadline is None:
+                    continue
+                if deadline > now:
+                    if next_deadline is None or deadline < next_deadline:
+                        next_deadline = deadline
+                    continue
+                with self._lock_for(wechat_contact_key):
+                    # 加锁后再次确认，期间可能有新消息顺延了到期时间，或该批次已被取走
+                    if self.contacts.get(wechat_contact_key) is not state or state.deadline is None:
+                        continue
+                    if state.deadline > now:
+                        if next_deadline is None or state.deadline < next_deadline:
+                            next_deadline = state.deadline
+                        continue
+                    state.deadline = None
+                self._trigger_process_batched_messages(wechat_contact_key)
+
+            with self._dispatch_cond:
+                timeout = None if next_deadline is None else max(0.0, next_deadline - time.monotonic())
+                self._dispatch_cond.wait_for(lambda: self._dispatch_wakeup, timeout=timeout)
+                self._dispatch_wakeup = False
 
     def _trigger_process_batched_messages(self, wechat_contact_key):
-        logger.info(f"计时器触发，为 {wechat_contact_key} 创建批处理任务线程。")
-        thread = threading.Thread(target=self._process_batched_messages_thread_target, args=(wechat_contact_key,), daemon=True)
-        thread.start()
+        logger.info(f"批次到期，将 {wechat_contact_key} 的批处理任务提交到线程池。")
+        future = self.batch_executor.submit(self._process_batched_messages_thread_target, wechat_contact_key)
+        future.add_done_callback(lambda f: self._log_batch_exception(f, wechat_contact_key))
+
+    def _log_batch_exception(self, future, wechat_contact_key):
+        # 线程池会吞掉任务中的异常，这里显式记录
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"处理 {wechat_contact_key} 的批处理消息时发生未捕获的错误: {future.exception()}", exc_info=future.exception())
 
     def _process_batched_messages_thread_target(self, wechat_contact_key):
         logger.info(f"线程开始处理 {wechat_contact_key} 的批处理消息...")
         messages_to_process = []
-        with self.buffer_locks[wechat_contact_key]: 
-            if wechat_contact_key in self.message_buffers: 
-                messages_to_process = self.message_buffers.pop(wechat_contact_key, []) 
-            
-            self.user_timers.pop(wechat_contact_key, None)
+        with self._lock_for(wechat_contact_key): 
+            state = self.contacts.pop(wechat_contact_key, None)
+            if state is not None:
+                messages_to_process = state.buffer
 
 
         if not messages_to_process:
@@ -87,7 +150,7 @@ class Application:
         logger.info(f"处理来自 {wechat_contact_key} 的 {len(messages_to_process)} 条消息。")
 
         first_msg = messages_to_process[0]
-        actual_sender_id = first_msg.get("sender_id") 
+        actual_sender_id = first_msg.sender_id 
         
         if not actual_sender_id:
             logger.error(f"批处理消息 (来自 {wechat_contact_key}) 中首条消息缺少 sender_id，无法生成 Dify 用户 ID。")
@@ -131,14 +194,18 @@ class Application:
             query_text,
             conversation_id=dify_conversation_id,
             files=dify_files_payload, 
-            stream=False 
+            stream=DIFY_STREAMING_REPLY 
         )
-        logger.debug(f"Dify 原始响应 (批处理 for {wechat_contact_key}): {str(dify_response)[:200]}...")
+        if isinstance(dify_response, requests.Response): # streaming 模式，边接收边发送
+            self._relay_dify_stream(dify_response, wechat_contact_key, first_msg)
+            return
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Dify 原始响应 (批处理 for %s): %s", wechat_contact_key, short_repr(dify_response))
 
         if dify_response:
             reply_to_id = wechat_contact_key 
             at_list_for_reply = None 
-            # if first_msg.get("is_group"):
+            # if first_msg.is_group:
             # at_list_for_reply = [actual_sender_id] 
             
             if isinstance(dify_response, dict) and not dify_response.get("error"): 
@@ -150,52 +217,15 @@ class Application:
                 actions_to_send_to_wechat = self.message_processor.prepare_wechat_response(dify_response, first_msg)
                 
                 if not actions_to_send_to_wechat:
-                    logger.warning(f"prepare_wechat_response 为 {wechat_contact_key} 返回空操作列表。Dify响应: {dify_response}")
+                    logger.warning(f"prepare_wechat_response 为 {wechat_contact_key} 返回空操作列表。Dify响应: {short_repr(dify_response)}")
                     # 可以选择发送一个通用错误消息
                     # self.wechat_client.send_text_message(reply_to_id, "抱歉，AI服务返回的内容无法解析。", at_wxid_list=at_list_for_reply)
 
-                for action in actions_to_send_to_wechat:
-                    action_type = action.get("type")
-                    if action_type == "text":
-                        text_content = action.get("content")
-                        if text_content:
-                            logger.info(f"准备将 Dify 文本回复发送到微信 {reply_to_id} (批处理): {text_content[:100].replace(chr(10), ' ')}...")
-                            self.wechat_client.send_text_message(reply_to_id, text_content, at_wxid_list=at_list_for_reply)
-                        else:
-                            logger.warning(f"收到的文本操作内容为空 (批处理 for {wechat_contact_key})。")
-                    
-                    elif action_type == "image":
-                        image_url = action.get("url")
-                        alt_text = action.get("alt_text", "图片") # 获取alt文本，用于日志
-                        if image_url:
-                            logger.info(f"Dify 返回图片 URL (批处理 for {wechat_contact_key})，描述: '{alt_text}', URL: {image_url}。尝试下载并转 Base64...")
-                            base64_content = url_to_base64(image_url) # utils.converters中的函数
-                            if base64_content:
-                                self.wechat_client.send_image_message_base64(reply_to_id, base64_content)
-                                logger.info(f"成功发送 Base64 图片到 {reply_to_id} (来自URL: {image_url})。")
-                            else:
-                                logger.error(f"图片 URL {image_url} 处理失败 (批处理 for {wechat_contact_key})。将发送错误文本。")
-                                self.wechat_client.send_text_message(reply_to_id, f"抱歉，我试图发送的图片（{alt_text}）处理失败了。", at_wxid_list=at_list_for_reply)
-                        else:
-                            logger.warning(f"收到的图片操作URL为空 (批处理 for {wechat_contact_key})。")
-                    else:
-                        logger.warning(f"未知的响应操作类型 '{action_type}' (批处理 for {wechat_contact_key})。")
+                self._send_wechat_actions(actions_to_send_to_wechat, reply_to_id, at_list_for_reply, wechat_contact_key)
 
             else: # Dify 响应中包含错误
-                error_message = "AI 服务返回异常，请稍后再试。"
-                if isinstance(dify_response, dict) and "error" in dify_response:
-                    status_code = dify_response.get('status_code', 'N/A')
-                    details = "未知错误详情"
-                    if isinstance(dify_response.get('details_json'), dict): 
-                        details = dify_response['details_json'].get('message', dify_response.get('error', details))
-                    elif isinstance(dify_response.get('details'), str): 
-                        details = dify_response.get('error', details) 
-                        details = details[:250] 
-                    else: 
-                        details = dify_response.get('error', details)
-                    
-                    error_message = f"AI 服务错误 (状态码: {status_code}): {details}"
-                logger.error(f"Dify API 错误详情 (批处理 for {wechat_contact_key}): {dify_response if isinstance(dify_response, dict) else str(dify_response)}")
+                error_message = self._format_dify_error(dify_response)
+                logger.error(f"Dify API 错误详情 (批处理 for {wechat_contact_key}): {short_repr(dify_response)}")
                 self.wechat_client.send_text_message(reply_to_id, error_message, at_wxid_list=at_list_for_reply)
         else: # Dify API 未返回任何响应
             logger.error(f"Dify API 未返回任何响应或响应为空 (批处理 for {wechat_contact_key})。")
@@ -203,6 +233,98 @@ class Application:
             self.wechat_client.send_text_message(wechat_contact_key, error_reply)
 
 
+    @staticmethod
+    def _format_dify_error(dify_response):
+        """把 DifyHandler 返回的错误 dict 转成发给微信用户的提示文本。"""
+        if not isinstance(dify_response, dict) or "error" not in dify_response:
+            return "AI 服务返回异常，请稍后再试。"
+        status_code = dify_response.get('status_code', 'N/A')
+        details_json = dify_response.get('details_json')
+        details = dify_response.get('details')
+        if isinstance(details_json, dict) and details_json.get('message'):
+            details = details_json['message']
+        elif not (isinstance(details, str) and details):
+            details = dify_response.get('error') or "未知错误详情"
+        return f"AI 服务错误 (状态码: {status_code}): {str(details)[:250]}"
+
+    def _relay_dify_stream(self, stream_response, wechat_contact_key, first_msg):
+        reply_to_id = wechat_contact_key
+        at_list_for_reply = None
+        text_buffer = ""
+        message_files = []
+        new_conversation_id = None
+        sent_any = False
+        for event in self.dify_handler.iter_chat_stream_events(stream_response):
+            event_type = event.get("event")
+            new_conversation_id = event.get("conversation_id") or new_conversation_id
+            if event_type in ("message", "agent_message"):
+                text_buffer += event.get("answer", "")
+                ready_text, text_buffer = self.message_processor.split_stream_text(text_buffer)
+                if ready_text and not ready_text.strip():
+                    # 只有空白 (如刚发送完一段后到达的 "\n\n") 时不发送，留在缓冲区与后续文本一起发出，
+                    # 否则 prepare_wechat_response 会给用户发一条 "[AI回复了空内容或无效格式]"
+                    text_buffer = ready_text + text_buffer
+                    ready_text = ""
+                if ready_text:
+                    actions = self.message_processor.prepare_wechat_response({"answer": ready_text}, first_msg)
+                    self._send_wechat_actions(actions, reply_to_id, at_list_for_reply, wechat_contact_key)
+                    sent_any = True
+            elif event_type == "message_file":
+                message_files.append(event)
+            elif event_type == "error":
+                logger.error(f"Dify 流式响应返回错误事件 (批处理 for {wechat_contact_key}): {event}")
+                actions = self.message_processor.prepare_wechat_response(
+                    {"error": event.get("message", "流式响应错误"), "details_json": event}, first_msg)
+                self._send_wechat_actions(actions, reply_to_id, at_list_for_reply, wechat_contact_key)
+                return
+
+        if new_conversation_id:
+            self.message_processor.set_dify_conversation_id(wechat_contact_key, new_conversation_id)
+
+        # 剩余不足一句的文本和 message_files 中的图片在流结束后一并发送；整个流都没有内容时由 prepare_wechat_response 给出默认提示
+        if text_buffer.strip() or message_files or not sent_any:
+            actions = self.message_processor.prepare_wechat_response(
+                {"answer": text_buffer, "message_files": message_files}, first_msg)
+            self._send_wechat_actions(actions, reply_to_id, at_list_for_reply, wechat_contact_key)
+
+    def _send_wechat_actions(self, actions, reply_to_id, at_list_for_reply, wechat_contact_key):
+        # 图片前后还有其它消息 (多张图片或图文混排) 时先并行开始下载，与文本发送重叠；发送时仍按原顺序逐条等待结果
+        image_actions = [action for action in actions if action.get("type") == "image" and action.get("url")]
+        image_downloads = {}
+        if image_actions and len(actions) > 1:
+            image_downloads = {
+                id(action): self.download_executor.submit(url_to_base64, action["url"], self.download_session)
+                for action in image_actions
+            }
+
+        for action in actions:
+            action_type = action.get("type")
+            if action_type == "text":
+                text_content = action.get("content")
+                if text_content:
+                    logger.info(f"准备将 Dify 文本回复发送到微信 {reply_to_id} (批处理): {text_content[:100].replace(chr(10), ' ')}...")
+                    self.wechat_client.send_text_message(reply_to_id, text_content, at_wxid_list=at_list_for_reply)
+                else:
+                    logger.warning(f"收到的文本操作内容为空 (批处理 for {wechat_contact_key})。")
+
+            elif action_type == "image":
+                image_url = action.get("url")
+                alt_text = action.get("alt_text", "图片") # 获取alt文本，用于日志
+                if image_url:
+                    logger.info(f"Dify 返回图片 URL (批处理 for {wechat_contact_key})，描述: '{alt_text}', URL: {image_url}。尝试下载并转 Base64...")
+                    download = image_downloads.get(id(action))
+                    base64_content = download.result() if download else url_to_base64(image_url, self.download_session) # utils.converters中的函数
+                    if base64_content:
+                        self.wechat_client.send_image_message_base64(reply_to_id, base64_content)
+                        logger.info(f"成功发送 Base64 图片到 {reply_to_id} (来自URL: {image_url})。")
+                    else:
+                        logger.error(f"图片 URL {image_url} 处理失败 (批处理 for {wechat_contact_key})。将发送错误文本。")
+                        self.wechat_client.send_text_message(reply_to_id, f"抱歉，我试图发送的图片（{alt_text}）处理失败了。", at_wxid_list=at_list_for_reply)
+                else:
+                    logger.warning(f"收到的图片操作URL为空 (批处理 for {wechat_contact_key})。")
+            else:
+                logger.warning(f"未知的响应操作类型 '{action_type}' (批处理 for {wechat_contact_key})。")
+
     def run(self):
         logger.info("正在启动 WeChat WebSocket 客户端...")
         self.wechat_client.connect_websocket()
@@ -218,13 +340,21 @@ class Application:
     def stop(self):
         logger.info("正在停止应用程序...")
         shutdown_event.set()
-
-        logger.info("正在取消所有待处理的消息计时器...")
-        for key in list(self.user_timers.keys()): 
-            timer = self.user_timers.pop(key, None) 
-            if timer:
-                timer.cancel() 
-        logger.info("所有计时器已尝试取消。")
+        self._wake_dispatcher()
+        # 先等调度线程退出，清理期间不会再有批次被提交到线程池
+        self._dispatcher_thread.join(timeout=5)
+
+        logger.info("正在丢弃所有未到期的批处理消息...")
+        for key in list(self.contacts.keys()): 
+            # 与其它读写路径一样在分片锁内操作：消息回调和 batch_executor 中的任务可能仍在访问同一联系人的状态
+            with self._lock_for(key):
+                state = self.contacts.pop(key, None) 
+            if state and state.deadline is not None:
+                logger.debug(f"{key} 的 {len(state.buffer)} 条未到期消息已丢弃。")
+        logger.info("所有未到期批次已清理。")
+
+        self.batch_executor.shutdown(wait=False)
+        self.download_executor.shutdown(wait=False)
 
         if self.wechat_client:
             self.wechat_client.close_websocket()
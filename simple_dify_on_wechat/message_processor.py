@@ -4,17 +4,62 @@ import re
 import requests
 import os
 import mimetypes
-import base64
-from urllib.parse import urlparse, unquote
+import functools
+try:
+    import pybase64 as base64 # 可选依赖：SIMD 加速的 base64 解码，接口与标准库一致
+except ImportError:
+    import base64
 import xml.etree.ElementTree as ET
+try:
+    from lxml import etree as lxml_etree # 可选依赖：C 实现的 XML 解析 + 预编译 XPath
+except ImportError:
+    lxml_etree = None
 import json
+import orjson
 import time
 import subprocess # 用于调用 ffmpeg
-
-from config import WECHAT_BOT_WXID, DIFY_USER_ID_PREFIX, WECHAT_API_BASE_URL, WECHAT_TOKEN_KEY, MAX_FILE_SIZE_MB
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import suppress
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from requests.adapters import HTTPAdapter
+
+from config import WECHAT_BOT_WXID, DIFY_USER_ID_PREFIX, WECHAT_API_BASE_URL, WECHAT_TOKEN_KEY, MAX_FILE_SIZE_MB, DIFY_STT_NATIVE_FORMATS
+from utils.log_utils import short_repr
+from wechat_client import WeChatMessage
 
 logger = logging.getLogger(__name__)
-conversation_store = {}
+
+# 保存的微信联系人 -> Dify 会话 ID 映射的最大数量，超出时淘汰最久未使用的联系人
+CONVERSATION_STORE_MAX_SIZE = 10000
+
+class LRUConversationStore:
+    """容量有限的会话 ID 存储 (按最近使用淘汰)，多个批处理线程共用，读写均加锁。"""
+    def __init__(self, maxsize):
+        self._maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+conversation_store = LRUConversationStore(CONVERSATION_STORE_MAX_SIZE)
 
 TEMP_AUDIO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp_audio")
 if not os.path.exists(TEMP_AUDIO_DIR):
@@ -25,24 +70,107 @@ if not os.path.exists(TEMP_AUDIO_DIR):
         logger.error(f"创建临时音频目录失败 {TEMP_AUDIO_DIR}: {e}")
         TEMP_AUDIO_DIR = None
 
+# 语音处理产生的临时文件前缀；启动时清理超过 TEMP_AUDIO_MAX_AGE_SECONDS 的残留文件 (如进程被强制结束时遗留的)
+TEMP_VOICE_FILE_PREFIX = "wechat_voice_"
+TEMP_AUDIO_MAX_AGE_SECONDS = 3600
+
+def _cleanup_stale_temp_audio():
+    if not TEMP_AUDIO_DIR:
+        return
+    expire_before = time.time() - TEMP_AUDIO_MAX_AGE_SECONDS
+    try:
+        with os.scandir(TEMP_AUDIO_DIR) as entries:
+            for entry in entries:
+                if not entry.name.startswith(TEMP_VOICE_FILE_PREFIX) or not entry.is_file():
+                    continue
+                try:
+                    if entry.stat().st_mtime < expire_before:
+                        os.remove(entry.path)
+                        logger.info(f"已清理残留的临时音频文件: {entry.path}")
+                except OSError as e_del:
+                    logger.warning(f"清理临时音频文件失败 '{entry.path}': {e_del}")
+    except OSError as e_scan:
+        logger.warning(f"扫描临时音频目录失败 {TEMP_AUDIO_DIR}: {e_scan}")
+
+_cleanup_stale_temp_audio()
+
+def _remove_temp_file(path):
+    """删除临时文件；文件已不存在时直接忽略，其它错误只记录警告。"""
+    try:
+        with suppress(FileNotFoundError):
+            os.unlink(path)
+            logger.debug("已删除临时文件: %s", path)
+    except OSError as e_del:
+        logger.warning(f"删除临时文件失败 '{path}': {e_del}")
+
+@functools.lru_cache(maxsize=2048)
+def _make_dify_user_id(prefix, wechat_sender_id):
+    # 活跃用户会连续发送大量消息，缓存后重复的发送者直接复用同一个字符串
+    return f"{prefix}{wechat_sender_id}"
+
+def _file_size(path):
+    """一次 stat 同时判断文件是否存在并取得大小；不存在时返回 -1。"""
+    try:
+        return os.stat(path).st_size
+    except (FileNotFoundError, NotADirectoryError):
+        return -1
+
+# 图片消息 XML 中的 <img> 节点 (根节点的直接子节点)
+_IMG_NODE_XPATH = lxml_etree.XPath('/*/img[1]') if lxml_etree is not None else None
+
+def _parse_image_xml_node(xml_content_str):
+    """解析图片消息 XML，返回 <img> 节点 (不存在时为 None)。已安装 lxml 时使用 lxml，否则使用 ElementTree。"""
+    if lxml_etree is not None:
+        img_nodes = _IMG_NODE_XPATH(lxml_etree.fromstring(xml_content_str.encode('utf-8')))
+        return img_nodes[0] if img_nodes else None
+    return ET.fromstring(xml_content_str).find("img")
+
+# 图片分块下载：首块确定总大小后，其余分块并行请求
+IMAGE_CHUNK_REQ_LEN = 65536 # 每个分块请求的 DataLen；总大小确定后，分块偏移即 range(首块长度, 总大小, IMAGE_CHUNK_REQ_LEN)
+IMAGE_CHUNK_WORKER_COUNT = 8 # 分块下载线程数，同时也是下载 Session 的连接池大小 (所有分块请求都在该线程池中发出)
+IMAGE_CHUNK_MAX_ATTEMPTS = 5 # 单个分块网络错误时的最大尝试次数；API 返回的业务错误不重试
+DIFY_UPLOAD_WORKER_COUNT = 8 # 同一批次图片并发上传到 Dify 的线程数
+_JSON_HEADERS = {"Content-Type": "application/json"}
+_ALLOWED_MSG_TYPES = frozenset({"text", "image", "voice"}) # 交给 Dify 处理的消息类型
+# 微信语音格式代码 -> (临时文件扩展名, ffmpeg 输入格式)；未知或缺失的代码按 SILK 处理
+_VOICE_FORMAT_MAP = {"4": (".amr", "amr"), "1": (".silk", "silk")}
+_DEFAULT_VOICE_FORMAT = (".silk", "silk")
+_IMAGE_URL_EXTENSIONS = frozenset({"jpg", "jpeg", "png", "gif", "webp"}) # 可从 CDN URL 沿用到上传文件名的扩展名
+# 嵌套字段缺失时的只读空字典，配合 `x.get(k) or _EMPTY` 使用，避免每次查找都新建 {} 默认值
+_EMPTY = MappingProxyType({})
+# 流式回复分段：遇到这些句末符号即可把之前的文本先发给微信；切出的部分 (去掉首尾空白) 不足 STREAM_FLUSH_MIN_CHARS 字时继续等待，避免消息过碎
+STREAM_SENTENCE_ENDINGS = ("。", "！", "？", "!", "?", "\n")
+STREAM_FLUSH_MIN_CHARS = 20
 
 class MessageProcessor:
+    # 预编译的正则，所有实例共用
+    # 切分用的模式只有一个捕获组：re.split 会把每个捕获组都插入结果列表，内层分组会让 alt 文本和 URL 被当成普通文本片段
+    MARKDOWN_IMAGE_SPLIT_RE = re.compile(r'(!\[.*?\]\(.*?\))')
+    MARKDOWN_IMAGE_RE = re.compile(r'!\[(.*?)\]\((.*?)\)')
+    HTML_TITLE_RE = re.compile(r"<title>(.*?)</title>", re.IGNORECASE | re.DOTALL)
+    HTML_BODY_RE = re.compile(r"<body.*?>(.*?)</body>", re.IGNORECASE | re.DOTALL)
+    HTML_TAG_RE = re.compile('<[^<]+?>')
+
     def __init__(self, dify_handler):
         self.dify_handler = dify_handler
         self.bot_wxid = WECHAT_BOT_WXID
         self.dify_user_id_prefix = DIFY_USER_ID_PREFIX
-        try:
-            self.max_upload_size_bytes = int(MAX_FILE_SIZE_MB) * 1024 * 1024
-        except ValueError:
-            logger.error(f"Invalid MAX_FILE_SIZE_MB value: {MAX_FILE_SIZE_MB}. Defaulting to 15MB.")
-            self.max_upload_size_bytes = 15 * 1024 * 1024
-        self.markdown_image_regex = r'!\[(.*?)\]\((.*?)\)'
+        self.max_upload_size_bytes = MAX_FILE_SIZE_MB * 1024 * 1024
+        # 可直接发送给 Dify STT 的语音格式；某格式被 Dify 拒绝后会从集合中移除，之后改走 ffmpeg 转换
+        self.stt_native_formats = set(DIFY_STT_NATIVE_FORMATS)
+        # 调用 WeChatPadPro 下载接口的连接复用 Session，避免每个分块重新建立 TCP 连接
+        self.session = requests.Session()
+        self.session.mount(WECHAT_API_BASE_URL, HTTPAdapter(pool_connections=2, pool_maxsize=IMAGE_CHUNK_WORKER_COUNT))
+        self._download_params = {"key": WECHAT_TOKEN_KEY}
+        self.image_download_executor = ThreadPoolExecutor(max_workers=IMAGE_CHUNK_WORKER_COUNT, thread_name_prefix="wx-img")
+        # 同一批次中的多张图片并发上传到 Dify，下一张图片从微信下载时上一张已在上传
+        self.upload_executor = ThreadPoolExecutor(max_workers=DIFY_UPLOAD_WORKER_COUNT, thread_name_prefix="dify-upload")
 
     def get_dify_user_id(self, wechat_sender_id):
         if not wechat_sender_id:
             logger.warning("微信 sender_id 为空，无法生成 Dify 用户 ID。")
             return None
-        return f"{self.dify_user_id_prefix}{wechat_sender_id}"
+        return _make_dify_user_id(self.dify_user_id_prefix, wechat_sender_id)
 
     def get_dify_conversation_id(self, wechat_contact_key):
         return conversation_store.get(wechat_contact_key)
@@ -50,49 +178,50 @@ class MessageProcessor:
     def set_dify_conversation_id(self, wechat_contact_key, dify_conversation_id):
         if wechat_contact_key and dify_conversation_id:
             conversation_store[wechat_contact_key] = dify_conversation_id
-            logger.debug(f"已更新会话 ID: {wechat_contact_key} -> {dify_conversation_id}")
+            logger.debug("已更新会话 ID: %s -> %s", wechat_contact_key, dify_conversation_id)
         else:
             logger.warning(f"设置会话 ID 失败，contact_key 或 dify_conversation_id 为空。")
 
     def should_process_wechat_message(self, wechat_msg):
-        if not wechat_msg or not isinstance(wechat_msg, dict):
+        if not isinstance(wechat_msg, WeChatMessage):
             logger.warning("无效的微信消息数据。")
             return False
-        msg_type = wechat_msg.get("type")
-        is_group = wechat_msg.get("is_group", False)
-        sender_id = wechat_msg.get("sender_id")
+        # 被忽略的消息大多是系统通知、撤回等非文本/图片/语音类型，先做类型过滤
+        msg_type = wechat_msg.type
+        if msg_type not in _ALLOWED_MSG_TYPES:
+            logger.debug("忽略非文本/图片/语音类型的消息: %s", msg_type)
+            return False
 
+        sender_id = wechat_msg.sender_id
         if not sender_id:
-            logger.debug(f"消息缺少有效的个人 sender_id，忽略。")
+            logger.debug("消息缺少有效的个人 sender_id，忽略。")
             return False
 
         if sender_id == self.bot_wxid:
-            logger.debug(f"消息来自机器人自身 ({sender_id})，忽略。")
+            logger.debug("消息来自机器人自身 (%s)，忽略。", sender_id)
             return False
 
-        if msg_type not in ["text", "image", "voice"]:
-            logger.debug(f"忽略非文本/图片/语音类型的消息: {msg_type}")
-            return False
+        is_group = wechat_msg.is_group
 
         if not is_group:
             logger.info(f"接收到好友 {sender_id} 的 {msg_type} 消息，符合处理条件。")
             return True
         else:
-            at_list = wechat_msg.get("at_list", [])
+            at_list = wechat_msg.at_list
             is_at_me = False
             if self.bot_wxid and at_list and self.bot_wxid in at_list:
                 is_at_me = True
 
             if is_at_me:
-                logger.info(f"接收到群聊 {wechat_msg.get('room_id')} 中来自 {sender_id} (昵称: {wechat_msg.get('sender_nickname', 'None')}) 的 @机器人 的 {msg_type} 消息，符合处理条件。")
+                logger.info(f"接收到群聊 {wechat_msg.room_id} 中来自 {sender_id} (昵称: {wechat_msg.sender_nickname}) 的 @机器人 的 {msg_type} 消息，符合处理条件。")
                 return True
             else:
-                logger.debug(f"群聊消息未 @机器人，忽略。群ID: {wechat_msg.get('room_id')}, 发送者: {sender_id}")
+                logger.debug("群聊消息未 @机器人，忽略。群ID: %s, 发送者: %s", wechat_msg.room_id, sender_id)
                 return False
         return False
 
     def _convert_audio_to_mp3(self, input_path, output_mp3_path, input_format_hint=None):
-        if not os.path.exists(input_path):
+        if _file_size(input_path) < 0:
             logger.error(f"输入音频文件不存在: {input_path}")
             return False
         try:
@@ -101,12 +230,14 @@ class MessageProcessor:
                 command.extend(["-f", input_format_hint])
             command.extend(["-i", input_path, output_mp3_path])
             
-            logger.info(f"执行转换命令: {' '.join(command)}")
+            if logger.isEnabledFor(logging.INFO): # 日志级别高于 INFO 时不拼接命令行
+                logger.info("执行转换命令: %s", ' '.join(command))
             result = subprocess.run(command, check=False, capture_output=True, text=True, timeout=30)
             
             if result.returncode == 0:
-                if os.path.exists(output_mp3_path) and os.path.getsize(output_mp3_path) > 0:
-                    logger.info(f"成功将 {input_path} (格式: {input_format_hint or '自动检测'}) 转换为 {output_mp3_path}")
+                output_size = _file_size(output_mp3_path)
+                if output_size > 0:
+                    logger.info(f"成功将 {input_path} (格式: {input_format_hint or '自动检测'}) 转换为 {output_mp3_path}, 大小: {output_size}B")
                     return True
                 else:
                     logger.error(f"ffmpeg报告成功但输出MP3文件无效或为空: {output_mp3_path}")
@@ -125,81 +256,138 @@ class MessageProcessor:
             logger.error(f"ffmpeg转换超时: {input_path}")
             return False
         except Exception as e:
-            logger.error(f"ffmpeg转换过程中发生未知错误: {e}", exc_info=True)
+            logger.error(f"ffmpeg转换过程中发生未知错误: {e!r}", exc_info=logger.isEnabledFor(logging.DEBUG))
             return False
 
+    def _transcribe_voice_file(self, dify_user_id, audio_path):
+        """
+        调用 Dify STT。audio_path 为未经转换的原生格式且被 Dify 拒绝时，禁用该格式的直传，
+        用 ffmpeg 转为 MP3 后重试一次。
+        只有 Dify HTTP 响应本身返回 400/415 才视为格式不受支持；audio_to_text 本地校验 (文件不存在、为空等) 返回的错误与格式无关，直接返回。
+        """
+        stt_response = self.dify_handler.audio_to_text(dify_user_id, audio_path)
+        native_format = os.path.splitext(audio_path)[1].lstrip('.').lower()
+        if (native_format == "mp3" or not isinstance(stt_response, dict) or not stt_response.get("http_error")
+                or stt_response.get("status_code") not in (400, 415)):
+            return stt_response
+
+        logger.warning(f"Dify STT 不接受 {native_format} 格式 ({stt_response.get('error')})，后续该格式改为先转换为 MP3。")
+        self.stt_native_formats.discard(native_format)
+        fallback_mp3_path = os.path.splitext(audio_path)[0] + ".mp3"
+        try:
+            if not self._convert_audio_to_mp3(audio_path, fallback_mp3_path, native_format):
+                return stt_response
+            return self.dify_handler.audio_to_text(dify_user_id, fallback_mp3_path)
+        finally:
+            _remove_temp_file(fallback_mp3_path)
+
+    def _fetch_image_chunk_with_retry(self, download_url, base_payload, start_pos, data_len, total_len):
+        """
+        请求 GetMsgBigImg 的一个分块。成功返回 (API Data 字段, 解码后的字节, iLen)，失败返回错误描述字符串。
+        """
+        # 各分块只有 Section 和 TotalLen 不同：在公共字段上补齐后用 orjson 序列化一次，重试时复用同一请求体
+        # (各分块并行请求，不能共用同一个可变的 payload dict)
+        payload_bytes = orjson.dumps(dict(base_payload, Section={"DataLen": data_len, "StartPos": start_pos}, TotalLen=total_len))
+        for attempt in range(1, IMAGE_CHUNK_MAX_ATTEMPTS + 1):
+            # 只有网络错误和 5xx 才重试；4xx 和响应体格式错误重试也不会变好，直接返回，避免一张坏图片长时间占用分块线程池
+            try:
+                response = self.session.post(download_url, params=self._download_params, data=payload_bytes, headers=_JSON_HEADERS, timeout=60)
+                response.raise_for_status()
+                response_body = response.content
+            except requests.exceptions.RequestException as e:
+                status_code = e.response.status_code if e.response is not None else None
+                if status_code is not None and status_code < 500:
+                    logger.error(f"图片下载块失败 (StartPos: {start_pos}): {e!r}")
+                    return f"HTTP错误({status_code})"
+                # 网络错误集中出现时每次都格式化堆栈代价很高，完整堆栈只在 DEBUG 级别输出
+                logger.error(f"图片下载块失败 (StartPos: {start_pos}, 尝试 {attempt}): {e!r}", exc_info=logger.isEnabledFor(logging.DEBUG))
+                if attempt < IMAGE_CHUNK_MAX_ATTEMPTS: time.sleep(min(attempt, 5))
+                continue
+
+            try:
+                # 分块响应体主要是约 87KB 的 base64 字符串，用 orjson 直接解析原始字节
+                res_json = orjson.loads(response_body) 
+                api_code = res_json.get("Code")
+                api_data_field_outer = res_json.get("Data") or _EMPTY
+                api_base_ret = (api_data_field_outer.get("BaseResponse") or _EMPTY).get("ret")
+                if api_code != 200 or api_base_ret != 0: return f"API错误({api_base_ret})"
+                image_chunk_data_field_inner = api_data_field_outer.get("Data") or _EMPTY
+                b64_chunk_raw = image_chunk_data_field_inner.get("Buffer")
+                returned_data_len = image_chunk_data_field_inner.get("iLen", 0)
+                if not b64_chunk_raw or returned_data_len <= 0:
+                    return api_data_field_outer, b"", 0
+                # validate=False 时解码器会跳过换行等非 base64 字符，无需先拆分再拼接去除空白
+                return api_data_field_outer, base64.b64decode(b64_chunk_raw, validate=False), returned_data_len
+            except (ValueError, TypeError, AttributeError) as e:
+                # orjson.JSONDecodeError 和 binascii.Error 都是 ValueError 的子类；Data 结构不符时为 TypeError/AttributeError
+                logger.error(f"图片下载块响应格式错误 (StartPos: {start_pos}): {e!r}", exc_info=logger.isEnabledFor(logging.DEBUG))
+                return "响应格式错误"
+        return "下载失败"
+
     def _get_wechat_file_data(self, wechat_msg_obj):
-        msg_id_original_str = str(wechat_msg_obj.get("raw", {}).get("msg_id", 0))
+        raw_msg_data = wechat_msg_obj.raw or _EMPTY
+        msg_id_original_str = str(raw_msg_data.get("msg_id", 0))
         try:
             msg_id_original = int(msg_id_original_str)
         except ValueError:
             logger.error(f"无法将消息ID '{msg_id_original_str}' 转换为整数。")
             msg_id_original = 0
 
-        msg_new_id = wechat_msg_obj.get("id")
-        msg_type = wechat_msg_obj.get("type")
+        msg_new_id = wechat_msg_obj.id
+        msg_type = wechat_msg_obj.type
 
         if msg_type == "voice":
-            b64_data = wechat_msg_obj.get("file_data_b64")
+            b64_data = wechat_msg_obj.file_data_b64 # 微信推送的原始 Base64，这里是它唯一一次被解码的地方
             if b64_data:
                 if not TEMP_AUDIO_DIR:
                     logger.error("临时音频目录不可用，无法处理语音文件。")
                     return None, "临时目录错误"
+                temp_input_path = None
+                temp_mp3_path = None
+                result_path = None # 返回给调用方的文件由调用方负责删除，其余临时文件在 finally 中统一清理
                 try:
-                    cleaned_b64_data = "".join(b64_data.split())
-                    missing_padding = len(cleaned_b64_data) % 4
+                    # 一次 C 级 translate 去掉空白，再补齐 '=' 填充后解码
+                    cleaned_b64_data = b64_data.encode('ascii', 'ignore').translate(None, b' \t\r\n')
+                    missing_padding = -len(cleaned_b64_data) & 3
                     if missing_padding:
-                        cleaned_b64_data += '=' * (4 - missing_padding)
-                    voice_bytes = base64.b64decode(cleaned_b64_data)
-
-                    voice_format_code = wechat_msg_obj.get("voice_format_code")
-                    input_extension = ".silk" 
-                    input_format_hint_for_ffmpeg = "silk" 
-
-                    if voice_format_code == "4": 
-                        input_extension = ".amr"
-                        input_format_hint_for_ffmpeg = "amr"
-                        logger.info(f"语音格式代码为 {voice_format_code}，将尝试作为 AMR 处理。")
-                    elif voice_format_code == "1": 
-                        logger.info(f"语音格式代码为 {voice_format_code}，将尝试作为 SILK 处理。")
-                    elif voice_format_code:
-                        logger.info(f"未知语音格式代码 {voice_format_code}，默认尝试作为 SILK 处理。")
-                    else:
-                        logger.info(f"未提供语音格式代码，默认尝试作为 SILK 处理。")
+                        cleaned_b64_data += b'=' * missing_padding
+                    voice_bytes = base64.b64decode(cleaned_b64_data, validate=False)
 
-                    temp_input_filename = f"wechat_voice_in_{msg_new_id}{input_extension}"
-                    temp_input_path = os.path.join(TEMP_AUDIO_DIR, temp_input_filename)
-                    
-                    temp_mp3_filename = f"wechat_voice_out_{msg_new_id}.mp3"
-                    temp_mp3_path = os.path.join(TEMP_AUDIO_DIR, temp_mp3_filename)
+                    voice_format_code = wechat_msg_obj.voice_format_code
+                    input_extension, input_format_hint_for_ffmpeg = _VOICE_FORMAT_MAP.get(voice_format_code, _DEFAULT_VOICE_FORMAT)
+                    logger.info("语音格式代码为 %s，将尝试作为 %s 处理。", voice_format_code or "未提供", input_format_hint_for_ffmpeg.upper())
 
-                    with open(temp_input_path, 'wb') as f_input:
+                    # 由 tempfile 生成唯一文件名，同一消息重复处理时也不会互相覆盖
+                    with tempfile.NamedTemporaryFile(dir=TEMP_AUDIO_DIR, prefix=f"{TEMP_VOICE_FILE_PREFIX}in_{msg_new_id}_", suffix=input_extension, delete=False) as f_input:
+                        temp_input_path = f_input.name
                         f_input.write(voice_bytes)
+                    temp_input_filename = os.path.basename(temp_input_path)
                     logger.info(f"原始语音数据 (消息ID: {msg_new_id}) 已保存到: {temp_input_path}")
 
-                    conversion_successful = self._convert_audio_to_mp3(temp_input_path, temp_mp3_path, input_format_hint_for_ffmpeg)
+                    if input_format_hint_for_ffmpeg in self.stt_native_formats:
+                        # Dify STT 可直接识别该格式，跳过 ffmpeg 子进程和重新编码
+                        logger.info(f"语音格式 {input_format_hint_for_ffmpeg} 配置为 Dify STT 原生支持，直接发送原始文件。")
+                        result_path = temp_input_path
+                        return temp_input_path, temp_input_filename
 
-                    if os.path.exists(temp_input_path):
-                        try:
-                            os.remove(temp_input_path)
-                            logger.debug(f"已删除临时输入音频文件: {temp_input_path}")
-                        except OSError as e_del_input:
-                            logger.warning(f"删除临时输入音频文件失败 '{temp_input_path}': {e_del_input}")
-                    
-                    if conversion_successful and os.path.exists(temp_mp3_path):
-                        logger.info(f"MP3文件已生成: {temp_mp3_path}, 大小: {os.path.getsize(temp_mp3_path)}B")
+                    mp3_fd, temp_mp3_path = tempfile.mkstemp(dir=TEMP_AUDIO_DIR, prefix=f"{TEMP_VOICE_FILE_PREFIX}out_{msg_new_id}_", suffix=".mp3")
+                    os.close(mp3_fd)
+                    temp_mp3_filename = os.path.basename(temp_mp3_path)
+
+                    # _convert_audio_to_mp3 成功时已确认输出文件存在且非空 (mkstemp 预先创建的是空文件)
+                    if self._convert_audio_to_mp3(temp_input_path, temp_mp3_path, input_format_hint_for_ffmpeg):
+                        logger.info(f"MP3文件已生成: {temp_mp3_path}")
+                        result_path = temp_mp3_path
                         return temp_mp3_path, temp_mp3_filename 
-                    else:
-                        if not os.path.exists(temp_mp3_path) and conversion_successful:
-                            logger.error(f"ffmpeg报告转换成功，但MP3文件未找到: {temp_mp3_path}")
-                        return None, f"音频转MP3失败(格式:{input_format_hint_for_ffmpeg})"
+                    return None, f"音频转MP3失败(格式:{input_format_hint_for_ffmpeg})"
 
                 except Exception as e:
-                    logger.error(f"保存或解码/转换语音数据失败 (消息ID: {msg_new_id}): {e}", exc_info=True)
-                    if 'temp_input_path' in locals() and os.path.exists(temp_input_path):
-                        try: os.remove(temp_input_path)
-                        except: pass
+                    logger.error(f"保存或解码/转换语音数据失败 (消息ID: {msg_new_id}): {e!r}", exc_info=logger.isEnabledFor(logging.DEBUG))
                     return None, "语音处理通用失败"
+                finally:
+                    for leftover_path in (temp_input_path, temp_mp3_path):
+                        if leftover_path and leftover_path != result_path:
+                            _remove_temp_file(leftover_path)
             else:
                 logger.warning(f"语音消息 {msg_new_id} 无内置b64数据。")
                 return None, "无内置语音数据"
@@ -207,25 +395,24 @@ class MessageProcessor:
         elif msg_type == "image":
             if msg_id_original == 0:
                 return None, "无效原始MsgID"
-            raw_msg_data = wechat_msg_obj.get("raw", {})
-            from_user_name = raw_msg_data.get("from_user_name", {}).get("str")
-            to_user_name = raw_msg_data.get("to_user_name", {}).get("str")
+            from_user_name = (raw_msg_data.get("from_user_name") or _EMPTY).get("str")
+            to_user_name = (raw_msg_data.get("to_user_name") or _EMPTY).get("str")
             xml_content_str = raw_msg_data.get("wechat_xml_content")
             if not xml_content_str:
-                xml_content_str = raw_msg_data.get("content", {}).get("str", "")
+                # raw 缺失时 msg_id 为 0 已在上面返回，这里写回的一定是真实的 raw 字典
+                xml_content_str = (raw_msg_data.get("content") or _EMPTY).get("str", "")
                 if not xml_content_str: return None, "缺少XML内容"
                 raw_msg_data["wechat_xml_content"] = xml_content_str
             estimated_total_len_from_xml = 0
             try:
-                img_xml_root = ET.fromstring(xml_content_str)
-                img_node = img_xml_root.find("img")
+                img_node = _parse_image_xml_node(xml_content_str)
                 if img_node is not None:
                     length_str = img_node.get("length")
                     hd_length_str = img_node.get("hdlength")
                     if hd_length_str and int(hd_length_str) > 0: estimated_total_len_from_xml = int(hd_length_str)
                     elif length_str and int(length_str) > 0: estimated_total_len_from_xml = int(length_str)
                 if estimated_total_len_from_xml == 0 : logger.warning(f"XML中图片长度解析为0或未找到。MsgID: {msg_id_original}")
-            except: logger.warning(f"解析图片XML长度失败。MsgID: {msg_id_original}")
+            except Exception: logger.warning(f"解析图片XML长度失败。MsgID: {msg_id_original}")
             if not from_user_name or not to_user_name: return None, "API参数不完整"
             if estimated_total_len_from_xml > self.max_upload_size_bytes:
                 error_msg = f"图片过大({estimated_total_len_from_xml // (1024*1024)}MB)"
@@ -234,81 +421,75 @@ class MessageProcessor:
             download_api_endpoint = "/message/GetMsgBigImg"
             full_download_url = f"{WECHAT_API_BASE_URL.rstrip('/')}{download_api_endpoint}"
             suggested_filename = f"wechat_image_{msg_new_id}.jpg"
-            cdn_url_identifier = wechat_msg_obj.get("file_url")
+            cdn_url_identifier = wechat_msg_obj.file_url
             if cdn_url_identifier:
                 try:
-                    parsed_cdn_url = urlparse(cdn_url_identifier)
-                    path_basename = os.path.basename(parsed_cdn_url.path)
-                    if path_basename and '.' in path_basename:
-                        temp_fn = unquote(path_basename)
-                        name_part, ext_part = os.path.splitext(temp_fn)
-                        if ext_part.lower() in ['.jpg', '.jpeg', '.png', '.gif', '.webp']:
-                            suggested_filename = f"wechat_image_{msg_new_id}{ext_part.lower()}"
+                    # 只需要路径最后一段的扩展名：去掉查询串和片段后用 rpartition 取出，无需完整解析 URL
+                    url_path = cdn_url_identifier.split('?', 1)[0].split('#', 1)[0]
+                    _, _, path_basename = url_path.rpartition('/')
+                    _, dot, ext_part = path_basename.rpartition('.')
+                    ext_part = ext_part.lower()
+                    if dot and ext_part in _IMAGE_URL_EXTENSIONS:
+                        suggested_filename = f"wechat_image_{msg_new_id}.{ext_part}"
                 except Exception as e_parse_url: logger.warning(f"解析CDN URL '{cdn_url_identifier}'提取文件名时出错: {e_parse_url}")
-            all_image_bytes_chunks = []
-            current_pos = 0
-            authoritative_total_len = 0 
-            first_request_done = False
-            PREFERRED_CHUNK_REQ_LEN = 65536 
-            MAX_DOWNLOAD_ATTEMPTS = 20
-            attempts = 0
+            base_payload = {"CompressType": 0, "FromUserName": from_user_name, "MsgId": msg_id_original, "ToUserName": to_user_name}
             logger.info(f"准备通过 WeChatPadPro API '{download_api_endpoint}' 分块下载图片 (原始MsgID: {msg_id_original}), XML预估大小: {estimated_total_len_from_xml if estimated_total_len_from_xml > 0 else '未知'}")
-            while attempts < MAX_DOWNLOAD_ATTEMPTS:
-                attempts += 1
-                request_total_len_in_payload = authoritative_total_len if first_request_done and authoritative_total_len > 0 else estimated_total_len_from_xml
-                if first_request_done and authoritative_total_len > 0 and current_pos >= authoritative_total_len: break 
-                if first_request_done and authoritative_total_len == 0:
-                    if all_image_bytes_chunks: break
-                    else: return None, "API未返回文件大小"
-                if authoritative_total_len > 0 : request_data_len = min(PREFERRED_CHUNK_REQ_LEN, authoritative_total_len - current_pos)
-                elif estimated_total_len_from_xml > 0: request_data_len = min(PREFERRED_CHUNK_REQ_LEN, estimated_total_len_from_xml - current_pos)
-                else: request_data_len = PREFERRED_CHUNK_REQ_LEN
-                if request_data_len <= 0: 
-                    if current_pos < (authoritative_total_len or estimated_total_len_from_xml or float('inf')): 
-                        request_data_len = PREFERRED_CHUNK_REQ_LEN
-                    else: break 
-                payload = {"CompressType": 0,"FromUserName": from_user_name,"MsgId": msg_id_original,"Section": {"DataLen": request_data_len, "StartPos": current_pos},"ToUserName": to_user_name,"TotalLen": request_total_len_in_payload }
+
+            # 第一块：顺序请求，用于确定权威的 TotalLen。同样提交到分块线程池执行，
+            # 使 self.session 上的并发请求数不超过 IMAGE_CHUNK_WORKER_COUNT (即连接池大小)，多个批次同时下载图片时也不会超出
+            first_req_len = min(IMAGE_CHUNK_REQ_LEN, estimated_total_len_from_xml) if estimated_total_len_from_xml > 0 else IMAGE_CHUNK_REQ_LEN
+            first_result = self.image_download_executor.submit(
+                self._fetch_image_chunk_with_retry, full_download_url, base_payload, 0, first_req_len, estimated_total_len_from_xml).result()
+            if isinstance(first_result, str): return None, first_result
+            api_data_field_outer, first_chunk_bytes, first_returned_len = first_result
+            authoritative_total_len = api_data_field_outer.get("TotalLen", 0)
+            if authoritative_total_len == 0: 
+                if estimated_total_len_from_xml > 0: authoritative_total_len = estimated_total_len_from_xml
+                elif first_returned_len > 0: authoritative_total_len = first_returned_len
+                else: return None, "无法确定文件大小"
+            logger.info(f"API首次响应 TotalLen: {authoritative_total_len} (XML预估: {estimated_total_len_from_xml})")
+            if authoritative_total_len > self.max_upload_size_bytes: return None, f"图片过大({authoritative_total_len // (1024*1024)}MB)"
+            if not first_chunk_bytes: return None, "未获取数据"
+            # 其余分块从 first_returned_len 开始请求：首块实际解码长度与 iLen 不一致时缓冲区会出现空洞或重叠；
+            # TotalLen 回退为 XML 预估值时，首块也可能比总大小更长，切片赋值会把缓冲区扩展到已校验的上限之外
+            if len(first_chunk_bytes) != first_returned_len or first_returned_len > authoritative_total_len:
+                logger.error(f"图片首块长度不符 (iLen: {first_returned_len}B, 实际: {len(first_chunk_bytes)}B, 总大小: {authoritative_total_len}B)。MsgID: {msg_id_original}")
+                return None, "分块数据不完整"
+
+            image_buf = bytearray(authoritative_total_len) # 总大小确定后一次性分配，各块解码后按偏移写入
+            image_buf[0:first_returned_len] = first_chunk_bytes
+            bytes_written = first_returned_len
+
+            # 其余分块的 (StartPos, DataLen) 已知，在连接池上并行请求，再按偏移写回
+            remaining_sections = [
+                (start_pos, min(IMAGE_CHUNK_REQ_LEN, authoritative_total_len - start_pos))
+                for start_pos in range(first_returned_len, authoritative_total_len, IMAGE_CHUNK_REQ_LEN)
+            ]
+            if remaining_sections:
+                section_futures = [
+                    self.image_download_executor.submit(self._fetch_image_chunk_with_retry, full_download_url, base_payload, start_pos, data_len, authoritative_total_len)
+                    for start_pos, data_len in remaining_sections
+                ]
                 try:
-                    response = requests.post(full_download_url, params={"key": WECHAT_TOKEN_KEY}, json=payload, timeout=60)
-                    response.raise_for_status()
-                    res_json = response.json() 
-                    api_code = res_json.get("Code")
-                    api_data_field_outer = res_json.get("Data", {}) 
-                    api_base_response = api_data_field_outer.get("BaseResponse", {})
-                    api_base_ret = api_base_response.get("ret")
-                    api_err_msg_str = api_base_response.get("errMsg", {}).get("str", "N/A")
-                    if api_code != 200 or api_base_ret != 0: return None, f"API错误({api_base_ret})" 
-                    if not first_request_done:
-                        new_authoritative_total_len = api_data_field_outer.get("TotalLen", 0)
-                        if new_authoritative_total_len == 0: 
-                            if estimated_total_len_from_xml > 0: authoritative_total_len = estimated_total_len_from_xml
-                            else: 
-                                current_chunk_len = api_data_field_outer.get("Data", {}).get("iLen", 0)
-                                if current_chunk_len > 0: authoritative_total_len = current_chunk_len
-                                else: return None, "无法确定文件大小"
-                        else: authoritative_total_len = new_authoritative_total_len
-                        logger.info(f"API首次响应 TotalLen: {authoritative_total_len} (XML预估: {estimated_total_len_from_xml})")
-                        first_request_done = True
-                        if authoritative_total_len > self.max_upload_size_bytes: return None, f"图片过大({authoritative_total_len // (1024*1024)}MB)"
-                    image_chunk_data_field_inner = api_data_field_outer.get("Data", {}) 
-                    b64_chunk_raw = image_chunk_data_field_inner.get("Buffer")
-                    returned_data_len = image_chunk_data_field_inner.get("iLen", 0)
-                    if b64_chunk_raw and returned_data_len > 0:
-                        decoded_chunk_bytes = base64.b64decode("".join(b64_chunk_raw.split()))
-                        all_image_bytes_chunks.append(decoded_chunk_bytes)
-                        current_pos += returned_data_len
-                        logger.info(f"块: {returned_data_len}B, 总计: {current_pos}/{authoritative_total_len if authoritative_total_len > 0 else '未知'}")
-                    elif returned_data_len == 0: break 
-                    else: break
-                except Exception as e:
-                    logger.error(f"图片下载块失败 (尝试 {attempts}): {e}", exc_info=True)
-                    if attempts >= MAX_DOWNLOAD_ATTEMPTS: return None, "下载失败"
-                    time.sleep(min(attempts, 5)); continue
-            if not all_image_bytes_chunks: return None, "未获取数据"
-            image_bytes = b"".join(all_image_bytes_chunks)
-            if not image_bytes: return None, "数据合并为空"
-            logger.info(f"图片下载成功 (原始MsgID: {msg_id_original}), 大小: {len(image_bytes)}B")
-            return image_bytes, suggested_filename 
+                    for (start_pos, data_len), future in zip(remaining_sections, section_futures):
+                        section_result = future.result()
+                        if isinstance(section_result, str):
+                            return None, section_result
+                        _, chunk_bytes, _ = section_result
+                        if not chunk_bytes: break # API 提前结束，只保留此前连续收到的数据
+                        if len(chunk_bytes) != data_len:
+                            logger.error(f"图片分块长度不符 (StartPos: {start_pos}, 期望: {data_len}B, 实际: {len(chunk_bytes)}B)。MsgID: {msg_id_original}")
+                            return None, "分块数据不完整"
+                        image_buf[start_pos:start_pos + data_len] = chunk_bytes
+                        bytes_written = start_pos + data_len
+                        logger.info("块: %dB, 总计: %d/%d", data_len, bytes_written, authoritative_total_len)
+                finally:
+                    # 出错返回或提前结束 (break) 时取消尚未开始的分块，避免它们继续占用线程和连接；已完成的 Future 上 cancel() 无副作用
+                    for pending_future in section_futures: pending_future.cancel()
+
+            del image_buf[bytes_written:] # 提前结束时丢弃未写入的预分配部分
+            logger.info(f"图片下载成功 (原始MsgID: {msg_id_original}), 大小: {bytes_written}B")
+            return image_buf, suggested_filename # bytearray 可直接交给 upload_file_to_dify 上传
         else:
             logger.warning(f"不支持的文件类型 '{msg_type}' (消息ID: {msg_new_id}) 进行数据获取。")
             return None, "不支持类型"
@@ -317,25 +498,26 @@ class MessageProcessor:
         all_content_parts = [] 
         all_dify_files_payload = []
         encountered_errors = []
+        pending_uploads = [] # (内容位置, 文件名提示, 消息序号, 发送者昵称, Future)
 
         if not wechat_msgs_list:
             logger.warning("prepare_batched_query_for_dify 被调用但消息列表为空。")
             return "", [], ["没有消息可处理"]
 
         first_msg = wechat_msgs_list[0]
-        is_group = first_msg.get("is_group", False)
-        room_id_for_prefix = first_msg.get("room_id") # 群ID
+        is_group = first_msg.is_group
+        room_id_for_prefix = first_msg.room_id # 群ID
         # sender_id_from_first_msg 是实际发送消息的个人wxid
-        sender_id_from_first_msg = first_msg.get("sender_id") 
+        sender_id_from_first_msg = first_msg.sender_id 
         # sender_nickname_from_first_msg 是实际发送消息的个人昵称
-        sender_nickname_from_first_msg = first_msg.get("sender_nickname") 
+        sender_nickname_from_first_msg = first_msg.sender_nickname 
 
         for i, wechat_msg in enumerate(wechat_msgs_list):
-            msg_type = wechat_msg.get("type")
+            msg_type = wechat_msg.type
             # original_content 对于群消息是 "wxid_xxx:\n" 之后的内容，对于私聊是完整内容
-            original_content = wechat_msg.get("content") 
-            current_sender_id_for_log = wechat_msg.get("sender_id", "未知用户")
-            current_sender_nickname_for_log = wechat_msg.get("sender_nickname") or current_sender_id_for_log
+            original_content = wechat_msg.content 
+            current_sender_id_for_log = wechat_msg.sender_id or "未知用户"
+            current_sender_nickname_for_log = wechat_msg.sender_nickname or current_sender_id_for_log
 
             if msg_type == "text":
                 if original_content is None:
@@ -344,10 +526,11 @@ class MessageProcessor:
                     encountered_errors.append(err_msg)
                     all_content_parts.append(f"[{err_msg}]")
                     continue
-                all_content_parts.append(original_content)
+                if original_content: # 其余分支追加的都是非空字符串，最后可直接 join
+                    all_content_parts.append(original_content)
 
             elif msg_type == "image":
-                logger.info(f"批处理：开始处理来自 {current_sender_nickname_for_log} 的图片消息 {wechat_msg.get('id')}...")
+                logger.info(f"批处理：开始处理来自 {current_sender_nickname_for_log} 的图片消息 {wechat_msg.id}...")
                 file_data_result = self._get_wechat_file_data(wechat_msg)
                 image_bytes, filename_hint_or_error = None, None
                 if isinstance(file_data_result, tuple) and len(file_data_result) == 2: 
@@ -362,22 +545,17 @@ class MessageProcessor:
                         logger.error(err_msg); encountered_errors.append(err_msg); all_content_parts.append(f"[{err_msg}]")
                     else:
                         logger.info(f"获取到的 image_bytes 长度: {len(image_bytes)}，准备上传 (文件名提示: {filename_hint})...")
-                        dify_upload_response = self.dify_handler.upload_file_to_dify(dify_user_id, image_bytes, filename_hint)
-                        if dify_upload_response and dify_upload_response.get("id"):
-                            dify_file_id = dify_upload_response.get("id"); dify_file_name = dify_upload_response.get("name", filename_hint)
-                            all_dify_files_payload.append({"type": "image", "transfer_method": "local_file", "upload_file_id": dify_file_id})
-                            all_content_parts.append(f"[图片: {dify_file_name}]"); logger.info(f"批处理：图片已上传至Dify ID: {dify_file_id}")
-                        else:
-                            error_detail = dify_upload_response.get('error', '上传响应无效') if isinstance(dify_upload_response, dict) else str(dify_upload_response)
-                            err_msg = f"系统消息：来自 {current_sender_nickname_for_log} 的第 {i+1} 张图片 '{filename_hint}' 上传Dify失败 ({error_detail})。"
-                            logger.error(err_msg + f" Dify响应: {dify_upload_response}"); encountered_errors.append(err_msg); all_content_parts.append(f"[{err_msg}]")
+                        # 上传交给线程池并发进行，先占住内容位置，循环结束后按原顺序回填
+                        pending_uploads.append((len(all_content_parts), filename_hint, i, current_sender_nickname_for_log,
+                                                self.upload_executor.submit(self.dify_handler.upload_file_to_dify, dify_user_id, image_bytes, filename_hint)))
+                        all_content_parts.append("")
                 else: 
                     error_reason = filename_hint_or_error if isinstance(filename_hint_or_error, str) else "未知图片获取错误"
                     err_msg = f"系统消息：来自 {current_sender_nickname_for_log} 的第 {i+1} 张图片数据获取失败 ({error_reason})。"
                     logger.error(err_msg); encountered_errors.append(err_msg); all_content_parts.append(f"[{err_msg}]")
             
             elif msg_type == "voice":
-                logger.info(f"批处理：开始处理来自 {current_sender_nickname_for_log} 的语音消息 {wechat_msg.get('id')}...")
+                logger.info(f"批处理：开始处理来自 {current_sender_nickname_for_log} 的语音消息 {wechat_msg.id}...")
                 file_data_result = self._get_wechat_file_data(wechat_msg)
                 local_mp3_path, mp3_filename_hint_or_error = None, None
                 
@@ -387,22 +565,22 @@ class MessageProcessor:
                     mp3_filename_hint_or_error = "内部返回值错误(语音)"
                     local_mp3_path = None
 
-                if local_mp3_path and isinstance(mp3_filename_hint_or_error, str) and os.path.exists(local_mp3_path):
+                local_file_size = _file_size(local_mp3_path) if local_mp3_path else -1 # 同一次 stat 用于存在判断和大小检查
+                if local_file_size >= 0 and isinstance(mp3_filename_hint_or_error, str):
                     mp3_filename_hint = mp3_filename_hint_or_error
-                    logger.info(f"本地MP3文件已准备好: '{local_mp3_path}' (原始提示名: {mp3_filename_hint})，准备发送给Dify STT...")
+                    # 原生格式 (DIFY_STT_NATIVE_FORMATS) 不经 ffmpeg 转换，此时文件仍是 .amr/.silk 而不是 MP3
+                    logger.info(f"本地语音文件已准备好: '{local_mp3_path}' (原始提示名: {mp3_filename_hint})，准备发送给Dify STT...")
                     
                     stt_response = None
                     try:
-                        mp3_file_size = os.path.getsize(local_mp3_path)
-                        dify_stt_max_size = 15 * 1024 * 1024 
-                        effective_stt_limit = min(dify_stt_max_size, self.max_upload_size_bytes)
-                        if mp3_file_size > effective_stt_limit:
-                            err_msg = f"系统消息：转换后的MP3文件 '{mp3_filename_hint}' (大小: {mp3_file_size} bytes) 超出STT处理限制 ({effective_stt_limit // (1024*1024)}MB)。"
+                        # 与 audio_to_text 使用同一个预先计算的上限，两处不会不一致
+                        if local_file_size > self.dify_handler._stt_limit_bytes:
+                            err_msg = f"系统消息：语音文件 '{mp3_filename_hint}' (大小: {local_file_size} bytes) 超出STT处理限制 ({self.dify_handler._stt_limit_mb}MB)。"
                             logger.error(err_msg)
                             encountered_errors.append(err_msg)
                             all_content_parts.append(f"[{err_msg}]")
                         else:
-                            stt_response = self.dify_handler.audio_to_text(dify_user_id, local_mp3_path)
+                            stt_response = self._transcribe_voice_file(dify_user_id, local_mp3_path)
                             if stt_response and not stt_response.get("error") and "text" in stt_response:
                                 recognized_text = stt_response["text"]
                                 logger.info(f"批处理：Dify Audio-to-Text成功 (来自 {current_sender_nickname_for_log}): {recognized_text[:50]}...")
@@ -411,25 +589,20 @@ class MessageProcessor:
                             else:
                                 error_detail = stt_response.get('error', '未知STT错误') if isinstance(stt_response, dict) else str(stt_response)
                                 err_msg = f"系统消息：来自 {current_sender_nickname_for_log} 的第 {i+1} 条语音 '{mp3_filename_hint}' Dify STT失败 ({error_detail})。"
-                                logger.error(err_msg + f" Dify STT响应: {stt_response}")
+                                logger.error(err_msg + f" Dify STT响应: {short_repr(stt_response)}")
                                 encountered_errors.append(err_msg)
                                 all_content_parts.append(f"[{err_msg}]")
                     except Exception as e_stt: 
-                        logger.error(f"调用Dify STT时发生意外错误 for '{local_mp3_path}': {e_stt}", exc_info=True)
+                        logger.error(f"调用Dify STT时发生意外错误 for '{local_mp3_path}': {e_stt!r}", exc_info=logger.isEnabledFor(logging.DEBUG))
                         err_msg = f"系统消息：来自 {current_sender_nickname_for_log} 的第 {i+1} 条语音 '{mp3_filename_hint}' Dify STT调用时出错。"
                         encountered_errors.append(err_msg)
                         all_content_parts.append(f"[{err_msg}]")
                     finally: 
-                        if local_mp3_path and os.path.exists(local_mp3_path): 
-                            try:
-                                os.remove(local_mp3_path)
-                                logger.debug(f"已删除临时MP3文件: {local_mp3_path}")
-                            except OSError as e_del:
-                                logger.warning(f"删除临时MP3文件失败 '{local_mp3_path}': {e_del}")
+                        _remove_temp_file(local_mp3_path)
                 else: 
                     error_reason = mp3_filename_hint_or_error if isinstance(mp3_filename_hint_or_error, str) else "未知语音获取/转换错误"
                     err_msg = f"系统消息：来自 {current_sender_nickname_for_log} 的第 {i+1} 条语音数据处理失败 ({error_reason})。"
-                    if local_mp3_path and not os.path.exists(local_mp3_path): 
+                    if local_mp3_path and local_file_size < 0: 
                         err_msg += " (转换后文件未找到)"
                     logger.error(err_msg)
                     encountered_errors.append(err_msg)
@@ -437,6 +610,22 @@ class MessageProcessor:
             else:
                 logger.warning(f"批处理：跳过来自 {current_sender_nickname_for_log} 的未知或不支持类型的消息: {msg_type}")
 
+        # --- 汇总并发上传的图片，保持与消息相同的顺序 ---
+        for content_slot, filename_hint, i, sender_nickname, upload_future in pending_uploads:
+            try:
+                dify_upload_response = upload_future.result()
+            except Exception as e_upload:
+                logger.error(f"上传图片 '{filename_hint}' 到 Dify 时发生意外错误: {e_upload!r}", exc_info=logger.isEnabledFor(logging.DEBUG))
+                dify_upload_response = {"error": "上传时发生意外错误"}
+            if dify_upload_response and dify_upload_response.get("id"):
+                dify_file_id = dify_upload_response.get("id"); dify_file_name = dify_upload_response.get("name", filename_hint)
+                all_dify_files_payload.append({"type": "image", "transfer_method": "local_file", "upload_file_id": dify_file_id})
+                all_content_parts[content_slot] = f"[图片: {dify_file_name}]"; logger.info(f"批处理：图片已上传至Dify ID: {dify_file_id}")
+            else:
+                error_detail = dify_upload_response.get('error', '上传响应无效') if isinstance(dify_upload_response, dict) else str(dify_upload_response)
+                err_msg = f"系统消息：来自 {sender_nickname} 的第 {i+1} 张图片 '{filename_hint}' 上传Dify失败 ({error_detail})。"
+                logger.error(err_msg + f" Dify响应: {dify_upload_response}"); encountered_errors.append(err_msg); all_content_parts[content_slot] = f"[{err_msg}]"
+
         # --- 构造前缀 ---
         prefix_elements = []
         if is_group: # 群聊
@@ -457,7 +646,7 @@ class MessageProcessor:
             nlp_prefix_str = f"[{'，'.join(prefix_elements)}] "
         
         # --- 合并内容和前缀 ---
-        actual_message_content = "\n".join(filter(None, all_content_parts)).strip()
+        actual_message_content = "\n".join(all_content_parts).strip()
         
         if not actual_message_content: 
             if all_dify_files_payload:
@@ -471,19 +660,37 @@ class MessageProcessor:
         
         logger.info(f"构造的Dify查询 (前缀部分: '{nlp_prefix_str}', 内容部分: '{actual_message_content[:100].replace(chr(10), ' ')}...'), 完整查询 (前200字符): {final_query_text[:200].replace(chr(10), ' ')}")
         if len(final_query_text) > 200:
-             logger.debug(f"完整的Dify查询: {final_query_text}")
-        logger.debug(f"Dify 文件载荷: {all_dify_files_payload}")
+             logger.debug("完整的Dify查询: %s", final_query_text)
+        logger.debug("Dify 文件载荷: %s", all_dify_files_payload)
         if encountered_errors:
              logger.warning(f"Dify查询准备过程中遇到的错误: {encountered_errors}")
 
         return final_query_text, all_dify_files_payload, encountered_errors
 
+    def split_stream_text(self, text_buffer):
+        """
+        从流式累积的回复文本中切出可以先发送的完整句子部分，返回 (可发送部分, 剩余部分)。
+        未闭合的 Markdown 图片不会被切开，留到后续文本到达后再处理。
+        字数下限按切出的部分计算，而不是整个缓冲区：否则缓冲区较长时仍可能切出 "！" 或只有换行的片段。
+        """
+        if len(text_buffer) < STREAM_FLUSH_MIN_CHARS:
+            return "", text_buffer
+        searchable = text_buffer
+        image_start = text_buffer.rfind("![")
+        if image_start != -1 and not self.MARKDOWN_IMAGE_RE.match(text_buffer, image_start):
+            searchable = text_buffer[:image_start] # 只在未闭合的图片之前寻找句末
+        cut = max(searchable.rfind(ch) for ch in STREAM_SENTENCE_ENDINGS)
+        # 取最后一个句末符号切分，切出的部分已是最长；仍不足下限 (含只有空白的情况) 时整体留在缓冲区
+        if cut < 0 or len(text_buffer[:cut + 1].strip()) < STREAM_FLUSH_MIN_CHARS:
+            return "", text_buffer
+        return text_buffer[:cut + 1], text_buffer[cut + 1:]
+
     def prepare_wechat_response(self, dify_chat_response, original_wechat_msg_or_first_in_batch):
         actions_to_send = [] 
         default_error_text = "抱歉，AI服务暂时无法响应，请稍后再试。"
 
         if not dify_chat_response or isinstance(dify_chat_response, str):
-            logger.error(f"Dify 响应无效或为错误字符串: {dify_chat_response}")
+            logger.error(f"Dify 响应无效或为错误字符串: {short_repr(dify_chat_response)}")
             actions_to_send.append({"type": "text", "content": dify_chat_response if isinstance(dify_chat_response, str) else default_error_text})
             return actions_to_send
 
@@ -492,29 +699,29 @@ class MessageProcessor:
             if isinstance(dify_chat_response.get('details_json'), dict) and 'message' in dify_chat_response['details_json']:
                 error_detail = dify_chat_response['details_json']['message']
             elif isinstance(dify_chat_response.get('details'), str) and dify_chat_response['details']:
-                title_match = re.search(r"<title>(.*?)</title>", dify_chat_response['details'], re.IGNORECASE | re.DOTALL)
-                body_text_match = re.search(r"<body.*?>(.*?)</body>", dify_chat_response['details'], re.IGNORECASE | re.DOTALL)
+                title_match = self.HTML_TITLE_RE.search(dify_chat_response['details'])
+                body_text_match = self.HTML_BODY_RE.search(dify_chat_response['details'])
                 if title_match: error_detail = title_match.group(1).strip()
                 elif body_text_match:
-                    extracted_text = re.sub('<[^<]+?>', '', body_text_match.group(1)).strip()
+                    extracted_text = self.HTML_TAG_RE.sub('', body_text_match.group(1)).strip()
                     error_detail = extracted_text[:200] + "..." if len(extracted_text) > 200 else extracted_text
                 else: error_detail = dify_chat_response['error'] 
             else: error_detail = dify_chat_response.get('error', '错误详情未提供')
             text_to_send = f"AI 服务暂时遇到问题：{error_detail}"
-            logger.error(f"Dify API 返回错误: {text_to_send}. 原始Dify响应: {dify_chat_response}")
+            logger.error(f"Dify API 返回错误: {text_to_send}. 原始Dify响应: {short_repr(dify_chat_response)}")
             actions_to_send.append({"type": "text", "content": text_to_send})
             return actions_to_send
 
         answer_text = dify_chat_response.get("answer")
         
         if answer_text:
-            parts = re.split(f'({self.markdown_image_regex})', answer_text)
+            parts = self.MARKDOWN_IMAGE_SPLIT_RE.split(answer_text)
             
             for part in parts:
                 if not part: 
                     continue
                 
-                match = re.fullmatch(self.markdown_image_regex, part)
+                match = self.MARKDOWN_IMAGE_RE.fullmatch(part)
                 if match:
                     alt_text = match.group(1) 
                     image_url = match.group(2) 
@@ -526,18 +733,17 @@ class MessageProcessor:
                     if text_content:
                         actions_to_send.append({"type": "text", "content": text_content})
         else:
-            logger.warning(f"Dify 响应中未找到 'answer' 字段或为空: {dify_chat_response}")
+            logger.warning(f"Dify 响应中未找到 'answer' 字段或为空: {short_repr(dify_chat_response)}")
 
         dify_generated_files = dify_chat_response.get("message_files", []) 
         if dify_generated_files:
+            # 已加入的图片 URL 和是否已有文本消息各算一次，循环内只做 O(1) 判断
+            added_image_urls = {action["url"] for action in actions_to_send if action["type"] == "image"}
+            has_text_action = any(action["type"] == "text" for action in actions_to_send)
             for file_info in dify_generated_files:
                 if file_info.get("type") == "image" and file_info.get("url"):
-                    already_added = False
-                    for action in actions_to_send:
-                        if action["type"] == "image" and action["url"] == file_info["url"]:
-                            already_added = True
-                            break
-                    if not already_added:
+                    if file_info["url"] not in added_image_urls:
+                        added_image_urls.add(file_info["url"])
                         logger.info(f"Dify 通过 message_files 返回了一张生成的图片: {file_info['url']}")
                         actions_to_send.append({
                             "type": "image", 
@@ -545,13 +751,14 @@ class MessageProcessor:
                             "alt_text": file_info.get("name", "Dify生成的图片") 
                         })
                         if not answer_text: 
-                            if not any(action["type"] == "text" for action in actions_to_send):
+                            if not has_text_action:
                                 actions_to_send.insert(0, {"type": "text", "content": "[图片]"})
+                                has_text_action = True
         
         if not actions_to_send: 
             if not answer_text and not dify_generated_files:
                  actions_to_send.append({"type": "text", "content": default_error_text})
-                 logger.warning(f"Dify 响应既无有效文本也无生成的媒体文件。原始Dify响应: {dify_chat_response}")
-            elif answer_text and not any(action.get("content", "").strip() or action.get("url", "").strip() for action in actions_to_send):
+                 logger.warning(f"Dify 响应既无有效文本也无生成的媒体文件。原始Dify响应: {short_repr(dify_chat_response)}")
+            elif answer_text: # actions_to_send 为空，说明 answer 中没有可发送的文本或图片
                 actions_to_send.append({"type": "text", "content": "[AI回复了空内容或无效格式]"})
         return actions_to_send
\ No newline at end of file
@@ -0,0 +1,83 @@
+# tests/test_stream_relay.py
+# 运行: 在 simple_dify_on_wechat 目录下执行 python -m unittest discover tests
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# config 在导入时校验必要配置项；测试不发出任何网络请求，填入占位值即可
+for _key, _value in {
+    "WECHAT_API_BASE_URL": "http://127.0.0.1:1",
+    "WECHAT_WS_URL": "ws://127.0.0.1:1",
+    "WECHAT_TOKEN_KEY": "test",
+    "WECHAT_BOT_WXID": "wxid_bot",
+    "DIFY_API_KEY": "test",
+    "DIFY_BASE_URL": "http://127.0.0.1:1/v1",
+}.items():
+    os.environ.setdefault(_key, _value)
+
+import main
+from message_processor import MessageProcessor, STREAM_FLUSH_MIN_CHARS
+from wechat_client import WeChatMessage
+
+PLACEHOLDER_TEXT = "[AI回复了空内容或无效格式]"
+
+
+class StreamRelayTest(unittest.TestCase):
+    def setUp(self):
+        self.processor = MessageProcessor(dify_handler=None)
+        self.sent = []
+
+    def tearDown(self):
+        self.processor.image_download_executor.shutdown(wait=False)
+        self.processor.upload_executor.shutdown(wait=False)
+
+    def _relay(self, tokens):
+        """用给定的 answer 片段模拟一次 Dify 流式回复，返回发送到微信的文本列表。"""
+        events = [{"event": "message", "answer": token, "conversation_id": "c1"} for token in tokens]
+        events.append({"event": "message_end", "conversation_id": "c1"})
+        app = SimpleNamespace(
+            dify_handler=SimpleNamespace(iter_chat_stream_events=lambda response: iter(events)),
+            message_processor=self.processor,
+            wechat_client=SimpleNamespace(
+                send_text_message=lambda to, content, at_wxid_list=None: self.sent.append(content)),
+        )
+        app._send_wechat_actions = lambda *args: main.Application._send_wechat_actions(app, *args)
+        first_msg = WeChatMessage("1", {})
+        first_msg.sender_id = "wxid_a"
+        main.Application._relay_dify_stream(app, None, "wxid_a", first_msg)
+        return self.sent
+
+    def assertNoEmptyMessages(self, sent):
+        for content in sent:
+            self.assertTrue(content.strip(), f"发送了空白消息: {sent!r}")
+            self.assertNotEqual(content, PLACEHOLDER_TEXT, f"发送了占位提示: {sent!r}")
+
+    def test_short_reply_with_blank_line_token(self):
+        sent = self._relay(["你好。", "\n\n", "abc"])
+        self.assertNoEmptyMessages(sent)
+        self.assertEqual("".join(sent).replace("\n", ""), "你好。abc")
+
+    def test_blank_line_token_after_flush(self):
+        first_sentence = "这" * STREAM_FLUSH_MIN_CHARS + "。"
+        # 空行之后的文本足够长但没有句末符号：旧逻辑会把 "\n\n" 单独切出发送
+        sent = self._relay([first_sentence, "\n\n", "abc" * STREAM_FLUSH_MIN_CHARS])
+        self.assertNoEmptyMessages(sent)
+        self.assertEqual(sent[0], first_sentence)
+        self.assertIn("abc", sent[-1])
+
+    def test_short_cut_is_not_flushed_from_long_buffer(self):
+        # 缓冲区足够长，但最后一个句末符号之前只有一个字：不应单独发出 "！"
+        buffer = "你好！" + "没有句末符号的后续文本" * 3
+        ready, rest = self.processor.split_stream_text(buffer)
+        self.assertEqual(ready, "")
+        self.assertEqual(rest, buffer)
+
+    def test_whitespace_only_cut_is_not_flushed(self):
+        buffer = "\n\n" + "a" * (STREAM_FLUSH_MIN_CHARS * 2)
+        self.assertEqual(self.processor.split_stream_text(buffer), ("", buffer))
+
+
+if __name__ == "__main__":
+    unittest.main()
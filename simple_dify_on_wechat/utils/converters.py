@@ -1,59 +1,126 @@
 # utils/converters.py
-import base64
+try:
+    import pybase64 as base64 # 可选依赖：SIMD 加速的 base64 编解码，接口与标准库一致
+except ImportError:
+    import base64
+import mmap
+import os
 import requests
+from requests.adapters import HTTPAdapter
 import logging
 
 logger = logging.getLogger(__name__)
 
-def url_to_base64(url):
-    """从 URL 下载文件并将其转换为 Base64 编码的字符串。"""
+# 边下载边编码：每块 3 的整数倍字节可独立 Base64 编码后直接拼接 (中间块不会产生 '=' 填充)
+B64_STREAM_CHUNK_SIZE = 3 * 85 * 1024 # 约 255KB：10MB 上限的文件约 40 次读取
+
+_DOWNLOAD_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+# 调用方未传入 session 时使用的共享 Session，避免每次下载都重新建立 TCP/TLS 连接
+_default_session = requests.Session()
+_default_session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+_default_session.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+
+def url_to_base64(url, session=None):
+    """从 URL 下载文件并将其转换为 Base64 编码的字符串。传入 session 时使用其连接池，否则使用模块共享的 Session。"""
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
+        http = session or _default_session
+        # 限制从URL下载并直接转Base64的大小，以防Dify返回超大文件链接
+        max_size_for_url_b64 = 10 * 1024 * 1024 # 例如，限制为10MB
+
+        # 先用 HEAD 确认大小：GET 响应为 chunked (无 Content-Length) 时，超大文件要读到上限才能发现
+        # HEAD 失败或不被支持时不影响下载，仍由下面的 Content-Length 检查和读取计数兜底
+        try:
+            head_response = http.head(url, timeout=10, headers=_DOWNLOAD_HEADERS, allow_redirects=True)
+            head_length = head_response.headers.get('Content-Length') if head_response.ok else None
+            if head_length and head_length.isdigit() and int(head_length) > max_size_for_url_b64:
+                logger.error(f"从URL {url} 下载的文件大小 ({head_length} bytes, HEAD) 超过直接Base64转换限制 ({max_size_for_url_b64} bytes)。")
+                return None
+        except requests.exceptions.RequestException as e_head:
+            logger.debug("HEAD 预检 %s 失败，直接下载: %r", url, e_head)
+
         # Dify返回的媒体链接通常不需要特别大的超时，但30秒是合理的
-        response = requests.get(url, timeout=30, headers=headers, stream=True) 
+        response = http.get(url, timeout=30, headers=_DOWNLOAD_HEADERS, stream=True) 
         response.raise_for_status()
 
-        # 限制从URL下载并直接转Base64的大小，以防Dify返回超大文件链接
-        max_size_for_url_b64 = 10 * 1024 * 1024 # 例如，限制为10MB
         content_length = response.headers.get('Content-Length')
         if content_length and int(content_length) > max_size_for_url_b64:
             logger.error(f"从URL {url} 下载的文件大小 ({content_length} bytes) 超过直接Base64转换限制 ({max_size_for_url_b64} bytes)。")
+            response.close()
             return None
 
-        content = b''
+        # 未压缩且已知 Content-Length 时按最终 Base64 长度一次性分配，各块编码结果按偏移写入，避免结果缓冲区反复扩容复制；
+        # 实际长度与预估不符时切片赋值会自动扩展，结尾再截掉多余部分
+        expected_len = int(content_length) if content_length and not response.headers.get('Content-Encoding') else 0
+        encoded = bytearray(4 * ((expected_len + 2) // 3))
+        out_pos = 0
+        pending = b'' # 上一块中不足 3 字节、留给下一块一起编码的尾部
         bytes_read = 0
-        for chunk in response.iter_content(chunk_size=8192): # Read in chunks
-            if chunk: # filter out keep-alive new chunks
-                content += chunk
-                bytes_read += len(chunk)
-                if bytes_read > max_size_for_url_b64:
-                    logger.error(f"下载文件 {url} 时，读取字节 ({bytes_read}) 超过限制 ({max_size_for_url_b64} bytes)。")
-                    # Clean up stream
-                    response.close()
-                    return None
+        # 复用同一块缓冲区读取响应体，避免 iter_content 为每个块新建 bytes 对象
+        raw = response.raw
+        raw.decode_content = True # 与 iter_content 相同，透明处理 gzip/deflate
+        read_buf = bytearray(B64_STREAM_CHUNK_SIZE)
+        read_view = memoryview(read_buf)
+        while True:
+            n = raw.readinto(read_buf)
+            if not n:
+                break
+            bytes_read += n
+            if bytes_read > max_size_for_url_b64:
+                logger.error(f"下载文件 {url} 时，读取字节 ({bytes_read}) 超过限制 ({max_size_for_url_b64} bytes)。")
+                # Clean up stream
+                response.close()
+                return None
+            # 解压等情况下每次读到的长度不一定是 3 的倍数，只编码对齐部分。
+            # 上次剩下的尾部只和本块开头补齐成 3 字节单独编码，不把整块拼到尾部后面复制一遍
+            view = read_view[:n]
+            if pending:
+                fill = 3 - len(pending)
+                if n < fill:
+                    pending += view
+                    continue
+                piece = base64.b64encode(pending + view[:fill])
+                encoded[out_pos:out_pos + 4] = piece
+                out_pos += 4
+                view = view[fill:]
+            aligned_len = len(view) - len(view) % 3
+            piece = base64.b64encode(view[:aligned_len])
+            encoded[out_pos:out_pos + len(piece)] = piece
+            out_pos += len(piece)
+            pending = view[aligned_len:].tobytes() # 下次 readinto 会覆盖缓冲区，尾部需复制出来
         
-        if not content:
+        if not bytes_read:
             logger.warning(f"从 URL {url} 下载的内容为空。")
             return None
             
-        return base64.b64encode(content).decode('utf-8')
+        if pending:
+            encoded[out_pos:out_pos + 4] = base64.b64encode(pending)
+            out_pos += 4
+        del encoded[out_pos:]
+        # 微信接口用 JSON 传输 Base64，orjson 不能直接序列化 bytes，这里仍需解码为 str (ASCII 快速路径)
+        return encoded.decode('ascii')
     except requests.exceptions.RequestException as e:
         logger.error(f"从 URL 下载文件失败 {url}: {e}")
         return None
     except Exception as e:
-        logger.error(f"转换 URL 内容到 Base64 时出错 {url}: {e}", exc_info=True)
+        # 完整堆栈只在 DEBUG 级别输出
+        logger.error(f"转换 URL 内容到 Base64 时出错 {url}: {e!r}", exc_info=logger.isEnabledFor(logging.DEBUG))
         return None
 
 def file_path_to_base64(file_path):
     """读取本地文件并将其转换为 Base64 编码的字符串。"""
     try:
         with open(file_path, 'rb') as f:
-            return base64.b64encode(f.read()).decode('utf-8')
+            if os.fstat(f.fileno()).st_size == 0:
+                return '' # mmap 不能映射空文件
+            # 直接把文件映射交给编码器，不先 read() 出一份完整的 bytes
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return base64.b64encode(mm).decode('ascii')
     except IOError as e:
         logger.error(f"读取本地文件失败 {file_path}: {e}")
         return None
     except Exception as e:
-        logger.error(f"转换文件到 Base64 时出错 {file_path}: {e}", exc_info=True)
+        logger.error(f"转换文件到 Base64 时出错 {file_path}: {e!r}", exc_info=logger.isEnabledFor(logging.DEBUG))
         return None
@@ -0,0 +1,15 @@
+# utils/log_utils.py
+import reprlib
+
+# 日志中打印 Dify 响应等大对象时使用：reprlib 在构造字符串的过程中就按长度/元素数截断，
+# 不会像 str(obj)[:N] 那样先生成完整的 repr 再切片
+_short_repr = reprlib.Repr()
+_short_repr.maxlevel = 3
+_short_repr.maxdict = 10
+_short_repr.maxlist = 10
+_short_repr.maxstring = 200
+_short_repr.maxother = 200
+
+def short_repr(obj):
+    """返回对象截断后的 repr，用于日志输出。"""
+    return _short_repr.repr(obj)
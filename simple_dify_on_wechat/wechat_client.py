@@ -2,21 +2,70 @@
 import websocket # 使用 websocket-client 库
 import threading
 import time
-import json
+import orjson
 import logging
 import requests # 用于 HTTP API 调用
+from requests.adapters import HTTPAdapter
 import xml.etree.ElementTree as ET # 用于解析 XML 内容
 import re # 用于正则表达式解析
+try:
+    from lxml import etree as lxml_etree # 可选依赖：C 实现的 XML 解析，比 ElementTree 快
+except ImportError:
+    lxml_etree = None
 from config import WECHAT_WS_URL, WECHAT_API_BASE_URL, WECHAT_TOKEN_KEY, WECHAT_BOT_WXID
 
 logger = logging.getLogger(__name__)
 
+_JSON_HEADERS = {"Content-Type": "application/json"}
+CHATROOM_SUFFIX = "@chatroom" # 群聊 ID 的后缀
+# lxml 与 ElementTree 抛出的解析错误类型不同，统一捕获
+XML_PARSE_ERRORS = (ET.ParseError, lxml_etree.XMLSyntaxError) if lxml_etree is not None else (ET.ParseError,)
+
+def _parse_xml(xml_str):
+    """解析消息中的 XML 片段 (msg_source、图片、语音)。已安装 lxml 时使用 lxml，否则使用 ElementTree。"""
+    if lxml_etree is not None:
+        return lxml_etree.fromstring(xml_str.encode('utf-8'))
+    return ET.fromstring(xml_str)
+
+class WeChatMessage:
+    """
+    _parse_wechat_message 解析出的标准消息。
+    每条消息都会创建一个，用 __slots__ 固定字段，比 12 个键的字典更省内存，属性读写也不需要哈希查找。
+    """
+    __slots__ = ("id", "type", "is_group", "sender_id", "sender_nickname", "room_id", "content",
+                 "file_url", "file_data_b64", "at_list", "raw", "voice_format_code")
+
+    def __init__(self, msg_id, raw):
+        self.id = msg_id
+        self.type = None
+        self.is_group = False
+        self.sender_id = None # 实际发送消息的个人wxid (群聊时也是个人)
+        self.sender_nickname = None # 实际发送消息的个人昵称
+        self.room_id = None # 如果是群聊，群的ID
+        self.content = None # 消息的纯文本内容 (群聊时，不含 "wxid_xxx:\n" 前缀)
+        self.file_url = None
+        self.file_data_b64 = None
+        self.at_list = []
+        self.raw = raw
+        self.voice_format_code = None
+
+    def __repr__(self):
+        return f"WeChatMessage(id={self.id!r}, type={self.type!r}, sender_id={self.sender_id!r}, room_id={self.room_id!r})"
+
 class WeChatClient:
+    # 每条消息都会用到的正则，预编译后所有实例共用
+    GROUP_SENDER_ID_RE = re.compile(r"^(wxid_[a-zA-Z0-9]+?):\n")
+    GROUP_NICKNAME_RE = re.compile(r"^(.+?)(?:\s*在群聊中|\s*:\s*@|\s*:\s*\S)")
+    PRIVATE_NICKNAME_RE = re.compile(r"^(.*?)\s*:")
+
     def __init__(self, message_callback=None):
         self.ws_base_url = WECHAT_WS_URL
         self.api_base_url = WECHAT_API_BASE_URL
         self.token_key = WECHAT_TOKEN_KEY
         self.bot_wxid = WECHAT_BOT_WXID
+        # 发送消息等 HTTP API 调用复用同一个 Session 的 keep-alive 连接；多个批处理线程可能同时发送回复
+        self.session = requests.Session()
+        self.session.mount(self.api_base_url, HTTPAdapter(pool_connections=2, pool_maxsize=16))
         
         self.ws = None
         self.ws_thread = None
@@ -26,19 +75,27 @@ class WeChatClient:
         self.actual_ws_url = f"{self.ws_base_url.replace('http://', 'ws://').replace('https://', 'wss://')}/ws/GetSyncMsg?key={self.token_key}"
 
     def _on_message(self, ws, message):
-        logger.debug(f"收到原始 WebSocket 消息: {message[:500]}...") 
+        if logger.isEnabledFor(logging.DEBUG): # 每条 WebSocket 消息都会经过这里，非 DEBUG 级别时跳过切片和格式化
+            logger.debug(f"收到原始 WebSocket 消息: {message[:500].decode('utf-8', 'replace')}...") 
         try:
-            msg_data = json.loads(message)
+            msg_data = orjson.loads(message) # 每条推送都要解析，orjson 比标准库 json 快数倍，str/bytes 均可直接传入
             if self.message_callback:
                 processed_msg = self._parse_wechat_message(msg_data)
                 if processed_msg:
                     self.message_callback(processed_msg)
-        except json.JSONDecodeError:
-            logger.error(f"WebSocket 消息 JSON 解析失败: {message[:200]}")
+        except orjson.JSONDecodeError:
+            logger.error(f"WebSocket 消息 JSON 解析失败: {message[:200].decode('utf-8', 'replace')}")
         except Exception as e:
             logger.error(f"处理 WebSocket 消息时发生错误: {e}", exc_info=True)
 
     def _parse_wechat_message(self, raw_msg):
+        # 系统通知、表情、位置等消息远多于文本/图片/语音，先按类型过滤，避免白白解析发送者、昵称和 XML
+        msg_type = raw_msg.get("msg_type")
+        handler = self.MESSAGE_TYPE_HANDLERS.get(msg_type)
+        if handler is None:
+            logger.debug("未处理的微信消息类型: %s。原始数据ID: %s", msg_type, raw_msg.get("new_msg_id") or raw_msg.get("msg_id"))
+            return None
+
         unique_id_base = raw_msg.get("new_msg_id") 
         if not unique_id_base: 
             original_msg_id = raw_msg.get("msg_id", "")
@@ -46,22 +103,8 @@ class WeChatClient:
         else: 
             unique_id_base = str(unique_id_base)
 
-        standard_msg = {
-            "id": unique_id_base, 
-            "type": None,
-            "is_group": False,
-            "sender_id": None, # 实际发送消息的个人wxid (群聊时也是个人)
-            "sender_nickname": None, # 实际发送消息的个人昵称
-            "room_id": None, # 如果是群聊，群的ID
-            "content": None, # 消息的纯文本内容 (群聊时，不含 "wxid_xxx:\n" 前缀)
-            "file_url": None, 
-            "file_data_b64": None,
-            "at_list": [],
-            "raw": raw_msg, 
-            "voice_format_code": None 
-        }
+        standard_msg = WeChatMessage(unique_id_base, raw_msg)
 
-        msg_type = raw_msg.get("msg_type")
         from_user_name_obj = raw_msg.get("from_user_name", {})
         from_user_name_str = from_user_name_obj.get("str", "") # 可能是群ID或个人ID
         
@@ -72,20 +115,21 @@ class WeChatClient:
         # push_content: 例如 "momo在群聊中@了你" 或 "好友昵称: 文本消息"
         push_content_str = raw_msg.get("push_content", "") 
         
-        actual_content_for_type_parsing = content_str_from_obj 
+        # 群聊文本正文在 content 中的起始位置 ("wxid_xxx:\n" 前缀之后)；只有文本消息需要据此切片，图片/语音直接解析 content
+        text_start = 0
 
-        if from_user_name_str.endswith("@chatroom"):
-            standard_msg["is_group"] = True
-            standard_msg["room_id"] = from_user_name_str # 群ID
+        # 群聊判断只在这里做一次，后续 (包括 MessageProcessor / Application) 都读取 is_group
+        standard_msg.is_group = from_user_name_str.endswith(CHATROOM_SUFFIX)
+        if standard_msg.is_group:
+            standard_msg.room_id = from_user_name_str # 群ID
             
             # 从 content 中提取实际发送者的 wxid
-            sender_id_match = re.match(r"^(wxid_[a-zA-Z0-9]+?):\n", content_str_from_obj) 
+            sender_id_match = self.GROUP_SENDER_ID_RE.match(content_str_from_obj) 
             if sender_id_match:
-                standard_msg["sender_id"] = sender_id_match.group(1) # 个人 wxid
-                # 更新用于类型解析的实际内容，去除 "wxid_xxx:\n" 前缀
-                actual_content_for_type_parsing = content_str_from_obj[len(sender_id_match.group(0)):].strip()
+                standard_msg.sender_id = sender_id_match.group(1) # 个人 wxid
+                text_start = sender_id_match.end() # end() 直接给出前缀长度，无需先构造 group(0)
             else:
-                logger.debug(f"群消息 {standard_msg['id']} 未能从 content 字段按 'wxid_xxx:\\n' 模式提取个人发送者 wxid。原始 content: {content_str_from_obj[:100]}")
+                logger.debug("群消息 %s 未能从 content 字段按 'wxid_xxx:\\n' 模式提取个人发送者 wxid。原始 content: %.100s", standard_msg.id, content_str_from_obj)
                 # 如果无法从content中提取，可能需要其他方式或标记为未知
 
             # 从 push_content 中提取昵称 (改进逻辑)
@@ -96,107 +140,107 @@ class WeChatClient:
                 # 正则表达式尝试捕获消息内容前的昵称部分
                 # (.*?) 匹配尽可能少的字符，直到遇到 "在群聊中" 或 ":" 或消息末尾
                 # nickname_match = re.match(r"^(.*?)(?:\s*在群聊中|\s*:|$)", push_content_str)
-                nickname_match = re.match(r"^(.+?)(?:\s*在群聊中|\s*:\s*@|\s*:\s*\S)", push_content_str)
+                nickname_match = self.GROUP_NICKNAME_RE.match(push_content_str)
                 if nickname_match:
                     potential_nickname = nickname_match.group(1).strip()
                     if potential_nickname: 
-                        standard_msg["sender_nickname"] = potential_nickname
-                        logger.debug(f"从 push_content ('{push_content_str}') 中为群消息提取到昵称: '{potential_nickname}'")
+                        standard_msg.sender_nickname = potential_nickname
+                        logger.debug("从 push_content ('%s') 中为群消息提取到昵称: '%s'", push_content_str, potential_nickname)
                     else:
-                        logger.debug(f"从 push_content ('{push_content_str}') 提取到的昵称为空。")
+                        logger.debug("从 push_content ('%s') 提取到的昵称为空。", push_content_str)
                 else:
-                    logger.debug(f"未能从 push_content ('{push_content_str}') 中按模式提取昵称。")
+                    logger.debug("未能从 push_content ('%s') 中按模式提取昵称。", push_content_str)
             
             msg_source_xml_str = raw_msg.get("msg_source", "")
             if msg_source_xml_str:
                 try:
-                    source_root = ET.fromstring(msg_source_xml_str)
+                    source_root = _parse_xml(msg_source_xml_str)
                     atuserlist_element = source_root.find("atuserlist")
                     if atuserlist_element is not None and atuserlist_element.text:
                         at_users_str = atuserlist_element.text
-                        standard_msg["at_list"] = [uid.strip() for uid in at_users_str.split(',') if uid.strip()]
-                except ET.ParseError as e_xml_source:
-                    logger.warning(f"解析群消息 {standard_msg['id']}的 msg_source XML 失败: {e_xml_source}. XML: {msg_source_xml_str[:200]}")
+                        standard_msg.at_list = [uid.strip() for uid in at_users_str.split(',') if uid.strip()]
+                except XML_PARSE_ERRORS as e_xml_source:
+                    logger.warning(f"解析群消息 {standard_msg.id}的 msg_source XML 失败: {e_xml_source}. XML: {msg_source_xml_str[:200]}")
         else: 
-            standard_msg["is_group"] = False
-            standard_msg["sender_id"] = from_user_name_str # 私聊时, from_user_name_str 就是个人wxid
-            actual_content_for_type_parsing = content_str_from_obj
+            standard_msg.sender_id = from_user_name_str # 私聊时, from_user_name_str 就是个人wxid
             # 私聊时，尝试从 push_content 提取昵称 (例如 "好友昵称: 文本消息")
             if push_content_str:
-                private_nick_match = re.match(r"^(.*?)\s*:", push_content_str)
+                private_nick_match = self.PRIVATE_NICKNAME_RE.match(push_content_str)
                 if private_nick_match:
                     potential_nickname = private_nick_match.group(1).strip()
                     if potential_nickname:
-                        standard_msg["sender_nickname"] = potential_nickname
-                        logger.debug(f"从 push_content ('{push_content_str}') 中为私聊消息提取到昵称: '{potential_nickname}'")
-
-
-        if msg_type == 1: 
-            standard_msg["type"] = "text"
-            standard_msg["content"] = actual_content_for_type_parsing
-        elif msg_type == 3: 
-            standard_msg["type"] = "image"
-            standard_msg["content"] = "[图片]" 
-            if content_str_from_obj:
-                 standard_msg["raw"]["wechat_xml_content"] = content_str_from_obj
-            try:
-                if content_str_from_obj:
-                    img_root = ET.fromstring(content_str_from_obj)
-                    img_element = img_root.find("img")
-                    if img_element is not None:
-                        hd_url = img_element.get("cdnhdurl")
-                        mid_url = img_element.get("cdnmidimgurl")
-                        thumb_url = img_element.get("cdnthumburl") 
-                        if hd_url: standard_msg["file_url"] = hd_url
-                        elif mid_url: standard_msg["file_url"] = mid_url
-                        elif thumb_url: standard_msg["file_url"] = thumb_url
-            except ET.ParseError:
-                logger.warning(f"解析图片消息 {standard_msg['id']} 内容XML提取URL失败。XML: {content_str_from_obj[:200]}")
-            
-        elif msg_type == 34: 
-            standard_msg["type"] = "voice"
-            standard_msg["content"] = "[语音]"
-            if content_str_from_obj:
-                standard_msg["raw"]["wechat_xml_content"] = content_str_from_obj
-                try:
-                    voice_xml_root = ET.fromstring(content_str_from_obj)
-                    voicemsg_node = voice_xml_root.find("voicemsg")
-                    if voicemsg_node is not None:
-                        standard_msg["voice_format_code"] = voicemsg_node.get("voiceformat")
-                        standard_msg["raw"]["voicelength"] = voicemsg_node.get("voicelength")
-                        cdn_url = voicemsg_node.get("cdnurl") # 或者 voiceurl
-                        if not cdn_url: cdn_url = voicemsg_node.get("voiceurl")
-                        if cdn_url : standard_msg["file_url"] = cdn_url
-                        logger.info(f"语音消息 {standard_msg['id']} 检测到 voiceformat: {standard_msg['voice_format_code']}")
-                    else:
-                        logger.warning(f"语音消息 {standard_msg['id']} 的XML中未找到 'voicemsg' 节点。XML: {content_str_from_obj[:200]}")
-                except ET.ParseError as e_xml_voice:
-                    logger.warning(f"解析语音消息 {standard_msg['id']} 内容XML失败: {e_xml_voice}. XML: {content_str_from_obj[:200]}")
-
-            img_buf_content = raw_msg.get("img_buf", {}) 
-            if img_buf_content.get("buffer") and img_buf_content.get("len", 0) > 0:
-                standard_msg["file_data_b64"] = img_buf_content["buffer"]
-                logger.info(f"语音消息 {standard_msg['id']}：已从 img_buf 获取 base64 数据。")
-            else: 
-                logger.debug(f"语音消息 {standard_msg['id']}：img_buf 为空或无数据。")
-        
-        else:
-            logger.debug(f"未处理的微信消息类型: {msg_type}。原始数据ID: {standard_msg['id']}")
-            return None 
+                        standard_msg.sender_nickname = potential_nickname
+                        logger.debug("从 push_content ('%s') 中为私聊消息提取到昵称: '%s'", push_content_str, potential_nickname)
 
-        if not standard_msg["sender_id"] : 
-             logger.warning(f"解析消息后 sender_id 为空，忽略。消息ID: {standard_msg['id']}")
+        # 按消息类型分派到对应的解析函数，填充 type / content / 文件相关字段
+        handler(self, standard_msg, content_str_from_obj, text_start)
+
+        if not standard_msg.sender_id : 
+             logger.warning(f"解析消息后 sender_id 为空，忽略。消息ID: {standard_msg.id}")
              return None
         
-        # 确保 sender_nickname 如果是 None，则保持为 None，而不是 "N/A"
-        log_sender_nickname = standard_msg['sender_nickname'] if standard_msg['sender_nickname'] else 'None'
-
-        logger.info(f"成功解析微信消息: ID={standard_msg['id']}, 类型={standard_msg['type']}, "
-                    f"发信人ID={standard_msg['sender_id']}, 发信人昵称='{log_sender_nickname}', "
-                    f"群聊={standard_msg['is_group']}, 群ID={standard_msg['room_id']}, "
-                    f"提及={standard_msg['at_list']}")
+        # 每条消息都会记录一次；%-style 参数在 INFO 未启用时不会格式化
+        # sender_nickname 为空时同样显示为 'None'，而不是 "N/A"
+        logger.info("成功解析微信消息: ID=%s, 类型=%s, 发信人ID=%s, 发信人昵称='%s', 群聊=%s, 群ID=%s, 提及=%s",
+                    standard_msg.id, standard_msg.type, standard_msg.sender_id, standard_msg.sender_nickname or 'None',
+                    standard_msg.is_group, standard_msg.room_id, standard_msg.at_list)
         return standard_msg
 
+    def _fill_text_message(self, standard_msg, content_str, text_start):
+        standard_msg.type = "text"
+        # 群聊时去掉 "wxid_xxx:\n" 前缀；切片和 strip 只在文本消息上进行，图片/语音的 XML 可能有几 KB
+        standard_msg.content = content_str[text_start:].strip() if text_start else content_str
+
+    def _fill_image_message(self, standard_msg, content_str, text_start):
+        standard_msg.type = "image"
+        standard_msg.content = "[图片]" 
+        if content_str:
+             standard_msg.raw["wechat_xml_content"] = content_str
+        try:
+            if content_str:
+                img_root = _parse_xml(content_str)
+                img_element = img_root.find("img")
+                if img_element is not None:
+                    hd_url = img_element.get("cdnhdurl")
+                    mid_url = img_element.get("cdnmidimgurl")
+                    thumb_url = img_element.get("cdnthumburl") 
+                    if hd_url: standard_msg.file_url = hd_url
+                    elif mid_url: standard_msg.file_url = mid_url
+                    elif thumb_url: standard_msg.file_url = thumb_url
+        except XML_PARSE_ERRORS:
+            logger.warning(f"解析图片消息 {standard_msg.id} 内容XML提取URL失败。XML: {content_str[:200]}")
+
+    def _fill_voice_message(self, standard_msg, content_str, text_start):
+        standard_msg.type = "voice"
+        standard_msg.content = "[语音]"
+        if content_str:
+            standard_msg.raw["wechat_xml_content"] = content_str
+            try:
+                voice_xml_root = _parse_xml(content_str)
+                voicemsg_node = voice_xml_root.find("voicemsg")
+                if voicemsg_node is not None:
+                    standard_msg.voice_format_code = voicemsg_node.get("voiceformat")
+                    standard_msg.raw["voicelength"] = voicemsg_node.get("voicelength")
+                    cdn_url = voicemsg_node.get("cdnurl") # 或者 voiceurl
+                    if not cdn_url: cdn_url = voicemsg_node.get("voiceurl")
+                    if cdn_url : standard_msg.file_url = cdn_url
+                    logger.info("语音消息 %s 检测到 voiceformat: %s", standard_msg.id, standard_msg.voice_format_code)
+                else:
+                    logger.warning(f"语音消息 {standard_msg.id} 的XML中未找到 'voicemsg' 节点。XML: {content_str[:200]}")
+            except XML_PARSE_ERRORS as e_xml_voice:
+                logger.warning(f"解析语音消息 {standard_msg.id} 内容XML失败: {e_xml_voice}. XML: {content_str[:200]}")
+
+        img_buf_content = standard_msg.raw.get("img_buf", {}) 
+        if img_buf_content.get("buffer") and img_buf_content.get("len", 0) > 0:
+            # img_buf.buffer 本身就是 Base64 文本，原样保存；只在写临时音频文件做 STT 时解码一次，不会再重新编码
+            standard_msg.file_data_b64 = img_buf_content["buffer"]
+            logger.info("语音消息 %s：已从 img_buf 获取 base64 数据。", standard_msg.id)
+        else: 
+            logger.debug("语音消息 %s：img_buf 为空或无数据。", standard_msg.id)
+
+    # 支持的 msg_type -> 解析函数 (文本、图片、语音)；新增类型只需在这里登记
+    MESSAGE_TYPE_HANDLERS = {1: _fill_text_message, 3: _fill_image_message, 34: _fill_voice_message}
+
     def _on_error(self, ws, error):
         logger.error(f"WebSocket 错误: {error}")
 
@@ -230,7 +274,8 @@ class WeChatClient:
                                          on_message=self._on_message,
                                          on_error=self._on_error,
                                          on_close=self._on_close)
-        self.ws_thread = threading.Thread(target=self.ws.run_forever, daemon=True)
+        # skip_utf8_validation：文本帧不再先解码为 str，_on_message 收到原始 bytes 直接交给 orjson (orjson 自身会校验 UTF-8)
+        self.ws_thread = threading.Thread(target=self.ws.run_forever, kwargs={"skip_utf8_validation": True}, daemon=True)
         self.ws_thread.start()
 
     def _send_http_request(self, method, endpoint_path, params=None, json_payload=None, **kwargs):
@@ -239,13 +284,17 @@ class WeChatClient:
         if params:
             request_params.update(params)
         
-        request_kwargs = {'params': request_params, 'json': json_payload, 'timeout': (10, 60)} 
+        request_kwargs = {'params': request_params, 'timeout': (10, 60)} 
+        if json_payload is not None:
+            # 用 orjson 序列化请求体，代替 requests 的 json= (标准库 json.dumps)
+            request_kwargs['data'] = orjson.dumps(json_payload)
+            request_kwargs['headers'] = _JSON_HEADERS
         request_kwargs.update(kwargs)
 
         try:
-            response = requests.request(method, url, **request_kwargs)
+            response = self.session.request(method, url, **request_kwargs)
             response.raise_for_status() 
-            res_json = response.json() 
+            res_json = orjson.loads(response.content) 
             
             if res_json.get("Code") == 200 : 
                 return res_json.get("Data", res_json) 
@@ -256,7 +305,7 @@ class WeChatClient:
             logger.error(f"WeChat API HTTP 错误: {e.response.status_code} - {e.response.text[:200]}")
         except requests.exceptions.RequestException as e: 
             logger.error(f"WeChat API 请求错误 ({method} {url}): {e}")
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             logger.error(f"WeChat API 响应 JSON 解析失败: {response.text[:200] if 'response' in locals() else 'N/A'}")
         except Exception as e: 
             logger.error(f"发送 WeChat API HTTP 请求时发生未知错误: {e}", exc_info=True)
@@ -269,7 +318,7 @@ class WeChatClient:
             "ToUserName": recipient_wxid,
             "MsgType": 1
         }
-        if at_wxid_list and isinstance(at_wxid_list, list) and recipient_wxid.endswith("@chatroom"):
+        if at_wxid_list and isinstance(at_wxid_list, list) and recipient_wxid.endswith(CHATROOM_SUFFIX):
             msg_item["AtWxIDList"] = at_wxid_list
         
         payload = {"MsgItem": [msg_item]}